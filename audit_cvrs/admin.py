@@ -1,17 +1,80 @@
 from django.forms import TextInput, Textarea
 from django.contrib import admin
+from django.contrib import messages
+from django.contrib.admin.views.main import ChangeList
+from django.core.urlresolvers import reverse
+from django.db.models import Count
+from django.http import HttpResponseRedirect
+from django.shortcuts import get_object_or_404
+from django.utils.html import format_html
 from audit_cvrs.models import *
 import reversion
-
-class CVRInline(admin.TabularInline):
-    model = CVR
+from reversion.models import Version
 
 class CountyElectionAdmin(admin.ModelAdmin):
-    inlines = [ CVRInline, ]
+    """Link to the CVR changelist filtered by election, rather than an inline form per CVR,
+    which times out with a large sample"""
+
+    list_display = ('name', 'random_seed', 'cvrs')
+    readonly_fields = ('cvrs',)
+
+    def get_queryset(self, request):
+        return super(CountyElectionAdmin, self).get_queryset(request).annotate(cvr_count=Count('cvr'))
+
+    def cvrs(self, election):
+        if election.pk is None:
+            return ""
+        url = "%s?election__id__exact=%d" % (reverse('admin:audit_cvrs_cvr_changelist'), election.pk)
+        return format_html('<a href="{}">{} CVRs</a>', url, election.cvr_count)
+    cvrs.short_description = "CVRs"
+
+class DeferredTextChangeList(ChangeList):
+    "A changelist which doesn't load the large cvr_text and notes fields"
+
+    def get_queryset(self, request):
+        return super(DeferredTextChangeList, self).get_queryset(request).defer('cvr_text', 'notes')
 
 class CVRAdmin(reversion.admin.VersionAdmin):
     "Modify default layout of admin form"
-    list_display = ('name', 'status', 'discrepancy')
+    list_display = ('name', 'status', 'discrepancy', 'election')
+    list_filter = ('status', 'discrepancy', 'election')
+    list_select_related = ('election',)
+    search_fields = ('^name', '=status')
+    list_per_page = 100
+    show_full_result_count = False
+
+    def get_changelist(self, request, **kwargs):
+        return DeferredTextChangeList
+
+    def save_model(self, request, obj, form, change):
+        """Don't save a CVR, or a new version of it, when no fields changed.
+        (ignore_duplicate_revisions has no effect under the RevisionMiddleware.)"""
+
+        if change and not form.changed_data:
+            return
+        super(CVRAdmin, self).save_model(request, obj, form, change)
+
+    def recover_view(self, request, version_id, extra_context=None):
+        """Versions don't include the cvr_text, so a deleted CVR can only be recovered
+        if its text can be read from the CVR file again.  Refuse to recover it otherwise."""
+
+        version = get_object_or_404(Version, pk=version_id)
+        name = version.field_dict.get('name', '')
+        if stored_cvr_text(name) is None:
+            self.message_user(request, "Can't recover CVR %s: its text isn't kept in versions, and can't be found in the CVR file" % name,
+                              messages.ERROR)
+            return HttpResponseRedirect(reverse('admin:audit_cvrs_cvr_recoverlist'))
+        return super(CVRAdmin, self).recover_view(request, version_id, extra_context)
+
+    def construct_change_message(self, request, form, formsets, add=False):
+        """Record the old and new values of just the fields which changed, as the comment on the revision,
+        e.g. "status: Selected -> Completed; discrepancy: None -> 0"."""
+
+        if add or not form.changed_data:
+            return super(CVRAdmin, self).construct_change_message(request, form, formsets, add)
+
+        return "; ".join("%s: %s -> %s" % (field, form.initial.get(field), form.cleaned_data.get(field))
+                         for field in form.changed_data)
 
     formfield_overrides = {
         models.TextField: {'widget': Textarea(attrs={'rows':30, 'cols':40})},
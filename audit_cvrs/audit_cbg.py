@@ -8,24 +8,37 @@ Example: print CVRs for random selections from files with given prefix using giv
 
     audit_cbg.py -p co_arapahoe_2013g -m ../ballotManifest.csv -s 27405096441431501170
 
-ToDo:
-    Report sorted vote totals for each contest
-    Given info on number of winners per contest, list winners and margins
-    Calculate number of ballots to select, given selected contests
+Example: report sorted vote totals, winners, margins and expected sample sizes for each contest
+
+    audit_cbg.py -p co_arapahoe_2013g -t
+
+With -n 0, the number of ballots to select is the expected sample size for the
+contest with the smallest margin, among those selected with -c (or all of them).
 
+ToDo:
     Perhaps switch away from requirement for Pandas, which adds complexity
      But helps allow analysis in notebook, adds some convenience.
 """
 
 import os
+import io
 import sys
+import bisect
 import logging
+import collections
+import multiprocessing
 from optparse import OptionParser
 from datetime import datetime
 import re
+import json
+from collections import OrderedDict
 import sampler
+import rlacalc
+from manifest import BallotManifest, batch_label
 import math
+import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
 
 __author__ = "Neal McBurnett <http://neal.mcburnett.org/>"
 __version__ = "0.1.0"
@@ -39,30 +52,302 @@ parser.add_option("-p", "--prefix",
   help="prefix for CBG files, e.g. co_arapahoe_2013g" )
 
 parser.add_option("-m", "--manifest",
-  help="manifest file name" )
+  help="ballot manifest csv file with Tabulator, Batch and Ballots columns, e.g. as written by -w, "
+       "for the number of ballots in each box" )
+
+parser.add_option("-w", "--write_manifest",
+  help="write ballot manifest derived from the CVRs to this file" )
 
 parser.add_option("-s", "--seed",
   help="seed for random selection" )
 
-# FIXME: should be able to automatically calculate better default for number to select
 parser.add_option("-n", "--N",
-  type="int", default = 10,
-  help="number of ballots to select" )
+  type="int", default=10,
+  help="number of ballots to select, default 10.  With 0, the expected sample size for the smallest margin" )
+
+parser.add_option("-t", "--tally",
+  action="store_true", default=False,
+  help="report vote totals, winners, margins and sample sizes for each contest" )
+
+parser.add_option("--winners",
+  help="number of winners for contests with more than one, as comma-separated contest:winners pairs, e.g. 3:2,5:3" )
+
+parser.add_option("-r", "--risk",
+  type="float", default=10.0,
+  help="risk limit for sample size calculations, in percent, default 10" )
+
+parser.add_option("-c", "--contests",
+  help="comma-separated list of contest ids: only load the choices for these contests" )
+
+parser.add_option("--chunksize",
+  type="int", default=100000,
+  help="number of CVR rows to read at a time, default 100000" )
+
+parser.add_option("--jobs",
+  type="int",
+  help="scan the CVR file in chunks across this many processes, without loading it all into memory" )
+
+parser.add_option("-j", "--json",
+  action="store_true", default=False,
+  help="print the selected ballots as json rather than text" )
 
 parser.add_option("-d", "--debuglevel",
   type="int", default=logging.WARNING,
   help="Set logging level to debuglevel: DEBUG=10, INFO=20,\n WARNING=30 (the default), ERROR=40, CRITICAL=50")
 
+parser.add_option("--test",
+  action="store_true", default=False,
+  help="Run tests")
+
 # incorporate OptionParser usage documentation in our docstring
 __doc__ = __doc__.replace("%InsertOptionParserUsage%\n", parser.format_help())
 
 choiceIDre = re.compile(r'Choice_(?P<id>[0-9]*)_')
 ballotIDre = re.compile(r'(?P<type>..)-(?P<batch>[0-9]*)\+(?P<image>[0-9]*)')
 
+def cvr_columns(filename, usecols=None):
+    """Return the header of a CBG cvr.csv file, and the columns to read given usecols.
+    BallotID is always read."""
+
+    header = list(pd.read_csv(filename, nrows=0).columns)
+
+    if usecols is None:
+        return header, header
+
+    return header, ['BallotID'] + [c for c in header if c in usecols and c != 'BallotID']
+
+def cvr_dtypes(columns):
+    """Return compact dtypes for the given cvr.csv columns: nullable Int8 for choices rather
+    than float64, int16 for PrecinctID and BallotStyleID, and int8 for Status and Remade"""
+
+    dtype = dict((c, 'Int8') for c in columns if c.startswith('Choice_'))
+    dtype.update((c, t) for c, t in [('PrecinctID', 'int16'), ('BallotStyleID', 'int16'), ('Status', 'int8'), ('Remade', 'int8')] if c in columns)
+    return dtype
+
+def compact_ids(chunk):
+    """Replace the BallotID in a chunk of CVRs, e.g. AB-001+10003, by its components:
+    BallotType and Batch as categoricals, and Image as int32"""
+
+    ids = chunk['BallotID'].str.extract(ballotIDre, expand=True)
+    chunk.insert(0, 'Image', ids['image'].astype('int32'))
+    chunk.insert(0, 'Batch', ids['batch'].astype('category'))
+    chunk.insert(0, 'BallotType', ids['type'].astype('category'))
+    del chunk['BallotID']
+    return chunk
+
+def concat_chunks(chunks):
+    "Concatenate chunks of CVRs, using the same categories in each so they stay categorical"
+
+    for column in ('BallotType', 'Batch'):
+        categories = union_categoricals([chunk[column] for chunk in chunks]).categories
+        for chunk in chunks:
+            chunk[column] = chunk[column].cat.set_categories(categories)
+
+    return pd.concat(chunks)
+
+def read_cvr(filename, usecols=None, chunksize=100000):
+    """Read a CBG cvr.csv file into a DataFrame with compact dtypes, as described
+    in cvr_dtypes and compact_ids.
+
+    Only the columns in usecols are read, if given (BallotID always is).
+    The file is read chunksize rows at a time, so peak memory is the compact
+    result plus one chunk.
+    """
+
+    header, columns = cvr_columns(filename, usecols)
+
+    chunks = [compact_ids(chunk) for chunk in
+              pd.read_csv(filename, usecols=columns, dtype=cvr_dtypes(columns), chunksize=chunksize)]
+
+    if not chunks:
+        raise ValueError("No CVRs in %s" % filename)
+
+    cvr = concat_chunks(chunks).reset_index(drop=True)
+    logging.info("Read %d CVRs, using %d bytes" % (len(cvr), cvr.memory_usage(deep=True).sum()))
+    return cvr
+
+def choice_arrays(cvrs, choice_columns):
+    "Return NumPy arrays of the votes (0 or 1) and of which choices are on the ballot, for the given CVRs"
+
+    votes = np.column_stack([cvrs[c].fillna(0).astype('int8').values for c in choice_columns])
+    on_ballot = np.column_stack([cvrs[c].notnull().values for c in choice_columns])
+    return votes, on_ballot
+
+def tally_arrays(votes, on_ballot, column_contest):
+    "Return the vote total for each choice column, and a dictionary of the number of ballots including each contest"
+
+    contest_ballots = dict((contest, int(on_ballot[:, column_contest == contest].any(axis=1).sum()))
+                           for contest in np.unique(column_contest))
+    return votes.sum(axis=0, dtype=np.int64), contest_ballots
+
+def contest_runs(contests, voted):
+    """Return which of a ballot's choice columns start a new contest, and whether anything
+    was voted in each of those contests, given the contest and vote of each column.
+    A ballot may have no columns at all, e.g. when none of its contests were selected with -c.
+
+    >>> starts, contest_voted = contest_runs(np.array([3, 3, 5, 7, 7]), np.array([False, False, True, False, True]))
+    >>> starts.tolist(), contest_voted.tolist()
+    ([True, False, True, True, False], [False, True, True])
+    >>> starts, contest_voted = contest_runs(np.array([], dtype=int), np.array([], dtype=bool))
+    >>> starts.tolist(), contest_voted.tolist()
+    ([], [])
+    """
+
+    starts = np.ones(len(contests), dtype=bool)
+    starts[1:] = contests[1:] != contests[:-1]
+    contest_voted = np.bincount(np.cumsum(starts) - 1, weights=voted) > 0
+    return starts, contest_voted
+
+def manifest_runs(cvrs):
+    "Return a list of (type, batch, count) for each run of CVRs from the same batch"
+
+    types = cvrs['BallotType'].cat
+    batches = cvrs['Batch'].cat
+    type_codes = types.codes.values
+    batch_codes = batches.codes.values
+    starts = np.flatnonzero(np.r_[True, (type_codes[1:] != type_codes[:-1]) | (batch_codes[1:] != batch_codes[:-1])])
+    counts = np.diff(np.r_[starts, len(cvrs)])
+    return [(types.categories[type_codes[start]], batches.categories[batch_codes[start]], int(count))
+            for start, count in zip(starts, counts)]
+
+CHUNK_BYTES = 64 * 1024 * 1024
+
+def chunk_ranges(filename, chunk_bytes=CHUNK_BYTES):
+    """Split a csv file after its header into (start, end) byte ranges of about chunk_bytes,
+    aligned on line boundaries.  Assumes no quoted newlines, as in CBG cvr.csv files."""
+
+    size = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        f.readline()
+        boundaries = [f.tell()]
+        while boundaries[-1] + chunk_bytes < size:
+            f.seek(boundaries[-1] + chunk_bytes)
+            f.readline()
+            boundaries.append(f.tell())
+
+    if boundaries[-1] < size:
+        boundaries.append(size)
+
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+def read_range(filename, start, end, header, columns, chunksize):
+    "Yield compact chunks of the CVRs in the given byte range of a cvr.csv file with the given header"
+
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        data = io.BytesIO(f.read(end - start))
+
+    for chunk in pd.read_csv(data, header=None, names=header, usecols=columns, dtype=cvr_dtypes(columns), chunksize=chunksize):
+        yield compact_ids(chunk)
+
+def scan_range(args):
+    """Worker for ChunkedCVR: return the number of rows, manifest runs, vote totals
+    and ballots per contest for one byte range of a cvr.csv file"""
+
+    filename, start, end, header, columns, chunksize, choice_columns, column_contest = args
+
+    rows = 0
+    runs = []
+    vote_totals = np.zeros(len(choice_columns), dtype=np.int64)
+    contest_ballots = collections.Counter()
+
+    for chunk in read_range(filename, start, end, header, columns, chunksize):
+        rows += len(chunk)
+        runs.extend(manifest_runs(chunk))
+        totals, ballots = tally_arrays(*choice_arrays(chunk, choice_columns), column_contest=column_contest)
+        vote_totals += totals
+        contest_ballots.update(ballots)
+
+    return rows, runs, vote_totals, contest_ballots
+
+def fetch_range(args):
+    "Worker for ChunkedCVR: return the rows at the given offsets within one byte range, indexed by global row number"
+
+    filename, start, end, header, columns, chunksize, first_row, offsets = args
+
+    selected = []
+    chunk_start = 0
+    for chunk in read_range(filename, start, end, header, columns, chunksize):
+        wanted = [o - chunk_start for o in offsets if chunk_start <= o < chunk_start + len(chunk)]
+        if wanted:
+            rows = chunk.iloc[wanted]
+            rows.index = [first_row + chunk_start + w for w in wanted]
+            selected.append(rows)
+        chunk_start += len(chunk)
+
+    return selected
+
+class ChunkedCVR(object):
+    """A cvr.csv file scanned in byte-range chunks across a process pool, for files too big for one DataFrame.
+
+    Each worker computes the row count, manifest runs, vote totals and ballots per contest for
+    its chunk, so the totals and global row offsets of each chunk are known without holding
+    all the CVRs in memory.  fetch() then re-reads just the chunks holding the given rows.
+    """
+
+    def __init__(self, filename, header, columns, choice_columns, column_contest, jobs=2, chunksize=100000, chunk_bytes=CHUNK_BYTES):
+        self.filename = filename
+        self.header = header
+        self.columns = columns
+        self.jobs = jobs
+        self.chunksize = chunksize
+        self.ranges = chunk_ranges(filename, chunk_bytes)
+
+        results = self._map(scan_range, [(filename, start, end, header, columns, chunksize, choice_columns, column_contest)
+                                         for start, end in self.ranges])
+
+        self.offsets = []       # global row number of the first row in each chunk
+        self.rows = 0
+        self.runs = []
+        self.vote_totals = np.zeros(len(choice_columns), dtype=np.int64)
+        self.contest_ballots = collections.Counter()
+
+        for rows, runs, vote_totals, contest_ballots in results:
+            self.offsets.append(self.rows)
+            self.rows += rows
+            self.runs.extend(runs)
+            self.vote_totals += vote_totals
+            self.contest_ballots.update(contest_ballots)
+
+        logging.info("Scanned %d CVRs in %d chunks" % (self.rows, len(self.ranges)))
+
+    def _map(self, function, args):
+        if self.jobs <= 1:
+            return [function(a) for a in args]
+
+        pool = multiprocessing.Pool(self.jobs)
+        try:
+            return pool.map(function, args)
+        finally:
+            pool.close()
+            pool.join()
+
+    def fetch(self, rows):
+        "Return a DataFrame of the given sorted global row numbers, indexed by row number, including any duplicates"
+
+        by_chunk = collections.defaultdict(set)
+        for row in rows:
+            chunk = bisect.bisect_right(self.offsets, row) - 1
+            by_chunk[chunk].add(row - self.offsets[chunk])
+
+        args = [(self.filename, self.ranges[chunk][0], self.ranges[chunk][1], self.header, self.columns, self.chunksize,
+                 self.offsets[chunk], sorted(offsets))
+                for chunk, offsets in sorted(by_chunk.items())]
+
+        selected = [chunk for chunks in self._map(fetch_range, args) for chunk in chunks]
+        return concat_chunks(selected).loc[list(rows)]
+
+def ballot_id(ballot):
+    "Return the original BallotID of a ballot read via read_cvr, e.g. AB-001+10003"
+
+    return "%s-%s+%d" % (ballot['BallotType'], ballot['Batch'], ballot['Image'])
+
 class Audit(object):
-    def __init__(self, prefix, manifest):
+    def __init__(self, prefix, manifest, contests=None, chunksize=100000, jobs=None):
         """Create an Audit object with contests, choices, and CVRs,
-        based on the CBG files starting with given filename prefix"""
+        based on the CBG files starting with given filename prefix.
+        If contests is given, only load the choices for those contest ids.
+        If jobs is given, don't load all the CVRs, but scan them with a ChunkedCVR."""
 
         self.choices = pd.read_csv(prefix + '.choices.csv')
         self.contests = pd.read_csv(prefix + '.contests.csv')
@@ -85,15 +370,163 @@ class Audit(object):
                 name += " on " + self.contestid_name[contest]
             self.choiceid_name[choice_row[0]] = name
 
-        # Read in the cast vote records
-        self.cvr = pd.read_csv(prefix + '.cvr.csv')
-
-        # not used.  does this date from an earlier version?  self.manifest = pd.read_csv(manifest)
+        # Find which columns of the cast vote records to read
+        cvrfile = prefix + '.cvr.csv'
+        usecols = None
+        if contests is not None:
+            usecols = ['PrecinctID', 'BallotStyleID', 'Status', 'Remade'] + [
+                'Choice_%d_1' % choiceid for choiceid, contest in sorted(self.choiceid_contest.items()) if contest in contests]
+        header, columns = cvr_columns(cvrfile, usecols)
+
+        # Look up the choice id, contest and text for each choice column once, for tallies and display
+        self.choice_columns = [c for c in columns if c.startswith('Choice_')]
+        self.column_choice = np.array([choice_num(c) for c in self.choice_columns])
+        self.column_contest = np.array([self.choiceid_contest[choiceid] for choiceid in self.column_choice])
+        self.column_contest_line = np.array([" %d: %s\n" % (contest, self.contestid_name[contest]) for contest in self.column_contest], dtype=object)
+        self.column_invalid_line = np.array(["  invalid vote for %s\n" % self.contestid_name[contest] for contest in self.column_contest], dtype=object)
+        self.column_choice_line = np.array(["  %s\n" % self.choiceid_name[choiceid] for choiceid in self.column_choice], dtype=object)
+
+        # Read in the cast vote records, or with jobs, just scan them in chunks across a process pool
+        if jobs:
+            self.cvr = None
+            self.chunks = ChunkedCVR(cvrfile, header, columns, self.choice_columns, self.column_contest, jobs, chunksize)
+            self.ballot_count = self.chunks.rows
+            runs = self.chunks.runs
+        else:
+            self.chunks = None
+            self.cvr = read_cvr(cvrfile, usecols, chunksize)
+            self.ballot_count = len(self.cvr)
+            runs = manifest_runs(self.cvr)
+
+        # Derive a ballot manifest from the BallotIDs, keyed by (type, batch), in file order,
+        # adding each run of ballots from the same batch at once.
+        # CVRs are in scan order within each batch, so the position of a ballot in its batch is its
+        # rank there, which stays right even when image numbers have gaps.
+        self.ballot_manifest = BallotManifest()
+        for ballot_type, batch, count in runs:
+            self.ballot_manifest.add(ballot_type, batch, count)
+
+        # The given ballot manifest, if any, with the number of ballots in each physical box,
+        # used to count to a selected ballot from the top or bottom of its box
+        self.manifest = None
+        if manifest:
+            self.manifest = BallotManifest.read(manifest)
+            for ballot_type, batch, cvrs, ballots in self.ballot_manifest.differences(self.manifest):
+                logging.warning("Batch %s: %d CVRs but %d ballots in manifest %s" % (batch_label(ballot_type, batch), cvrs, ballots, manifest))
+
+    def locate(self, seqid):
+        """Return (batch label, position in batch, ballots to count, 'top' or 'bottom') for
+        the CVR at the given 0-based row, using the given manifest for box counts if any."""
+
+        ballot_type, batch, position = self.ballot_manifest.locate(seqid + 1)
+        manifest = self.ballot_manifest
+        if self.manifest is not None and position <= self.manifest.counts.get((ballot_type, batch), 0):
+            manifest = self.manifest
+        count, end = manifest.from_end(ballot_type, batch, position)
+        return batch_label(ballot_type, batch), position, count, end
+
+    def tally(self, winners=None, alpha=0.1):
+        """Tally all contests in one vectorized pass over the choice columns.
+
+        winners maps contest ids to the number of winners, by default 1.
+        Return two DataFrames: one with the vote total for each choice, sorted by
+        contest and then votes, and one per contest with the number of ballots
+        including it, total votes, winners, margin (between the last winner and
+        the runner-up), diluted margin (margin over all ballots in the CVR file),
+        and expected sample size from rlacalc for the given risk limit alpha.
+        """
+
+        choiceids = self.column_choice
+        contestids = self.column_contest
+        if self.chunks:
+            vote_totals, contest_ballots = self.chunks.vote_totals, self.chunks.contest_ballots
+        else:
+            vote_totals, contest_ballots = tally_arrays(*choice_arrays(self.cvr, self.choice_columns), column_contest=contestids)
+
+        choice_totals = pd.DataFrame({'ContestID': contestids,
+                                      'Contest': [self.contestid_name[c] for c in contestids],
+                                      'ChoiceID': choiceids,
+                                      'Choice': [self.choiceid_name[c] for c in choiceids],
+                                      'Votes': vote_totals},
+                                     columns=['ContestID', 'Contest', 'ChoiceID', 'Choice', 'Votes'])
+        choice_totals = choice_totals.sort_values(['ContestID', 'Votes'], ascending=[True, False]).reset_index(drop=True)
+
+        N = self.ballot_count
+        rows = []
+        for contest, totals in choice_totals.groupby('ContestID', sort=True):
+            ballots = contest_ballots[contest]
+            sorted_votes = totals['Votes'].values
+            nwinners = (winners or {}).get(contest, 1)
+            if nwinners > len(sorted_votes):
+                logging.error("Contest %s has %d winners, but only %d choices: all of them win" %
+                              (contest, nwinners, len(sorted_votes)))
+                nwinners = len(sorted_votes)
+            if len(sorted_votes) > nwinners:
+                margin = int(sorted_votes[nwinners - 1] - sorted_votes[nwinners])
+            else:
+                margin = int(sorted_votes[nwinners - 1])
+            diluted_margin = margin / float(N)
+
+            try:
+                samplesize = rlacalc.KM_Expected_sample_size_rounded(alpha, margin=diluted_margin)
+            except rlacalc.RLAError:
+                samplesize = float('nan')
+
+            rows.append((contest, self.contestid_name[contest], ballots, int(sorted_votes.sum()),
+                         ", ".join(totals['Choice'].values[:nwinners]), margin, diluted_margin, samplesize))
+
+        contest_totals = pd.DataFrame(rows, columns=['ContestID', 'Contest', 'Ballots', 'Votes', 'Winners',
+                                                     'Margin', 'DilutedMargin', 'SampleSize'])
+        return choice_totals, contest_totals
+
+    def render(self, cvrs, format='text'):
+        """Describe each of the given CVRs, e.g. self.selected, in bulk.
+
+        The CVRs must be indexed by their row in the cvr.csv file, for their positions in their batches.
+        With format 'text', return a list of strings, the same as pd.Series.display.
+        With format 'json', return a list of dictionaries with the BallotID, position,
+        BallotStyleID, and each contest on the ballot with the choices voted.
+        """
+
+        votes, on_ballot = choice_arrays(cvrs, self.choice_columns)
+        positions = [self.ballot_manifest.locate(seqid + 1)[2] for seqid in cvrs.index]
+        styles = cvrs['BallotStyleID'].values
+        ballotids = [ballot_id(ids) for ids in cvrs[['BallotType', 'Batch', 'Image']].to_dict('records')]
+
+        results = []
+        for i in range(len(cvrs)):
+            columns = np.flatnonzero(on_ballot[i])
+            voted = votes[i, columns] == 1
+            contests = self.column_contest[columns]
+
+            starts, contest_voted = contest_runs(contests, voted)
+
+            if format == 'json':
+                results.append(OrderedDict([
+                    ('BallotID', ballotids[i]), ('position', int(positions[i])), ('BallotStyleID', int(styles[i])),
+                    ('contests', [OrderedDict([('ContestID', int(contest)), ('Contest', self.contestid_name[contest]),
+                                               ('voted', bool(was_voted)),
+                                               ('choices', [self.choiceid_name[c] for c in self.column_choice[columns[(contests == contest) & voted]]])])
+                                  for contest, was_voted in zip(contests[starts], contest_voted)])]))
+                continue
+
+            # Note an invalid vote before each new contest which follows one with no votes
+            invalid = np.zeros(len(columns), dtype=object)
+            invalid[:] = ''
+            start_columns = np.flatnonzero(starts)
+            after_unvoted = start_columns[1:][~contest_voted[:-1]]
+            invalid[after_unvoted] = self.column_invalid_line[columns[after_unvoted - 1]]
+
+            lines = np.where(starts, invalid + self.column_contest_line[columns], '') + np.where(voted, self.column_choice_line[columns], '')
+            show = "%s #%d (%s):\n" % (ballotids[i], positions[i], styles[i])
+            results.append(show + ''.join(lines)[:-1])
+
+        return results
 
     def select_ballots(self, seed, n):
         "Randomly select n ballots using Rivest's sampler library"
 
-        N = len(self.cvr) - 1
+        N = self.ballot_count - 1
         print("Ballot count: %d" % N)
 
         old_output_list, new_output_list = sampler.generate_outputs(n, True, 0, N, seed, False)
@@ -101,20 +534,19 @@ class Audit(object):
         # print new_output_list
         new_output_list = sorted(new_output_list)
 
-        self.selected = self.cvr.iloc[new_output_list]
+        if self.chunks:
+            self.selected = self.chunks.fetch(new_output_list)
+        else:
+            self.selected = self.cvr.iloc[new_output_list]
 
-        # print header row, with same column names as Stark's auditTools.htm
-        print('sorted_number,ballot, batch_label, which_ballot_in_batch')
+        # print header row, with same column names as Stark's auditTools.htm,
+        # plus which end of the box to count from
+        print('sorted_number,ballot, batch_label, which_ballot_in_batch, count_from')
 
-        for i, (seqid, ballot) in enumerate(self.selected.iterrows()):
-            # print i, ballot
-
-            m = ballotIDre.match(ballot['BallotID'])
-
-            batch = "%s-%s" % (m.groups()[:2])
-            image = int(m.group('image'))
-
-            print "%d,%d,%s,%d" % (i + 1, seqid, batch, (image - 10000) / 2)
+        # Ballots are numbered from 1, as in ballot manifests and for cvr.lookup_cvr
+        for i, seqid in enumerate(self.selected.index):
+            batch, position, count, end = self.locate(seqid)
+            print "%d,%d,%s,%d,%d from %s" % (i + 1, seqid + 1, batch, position, count, end)
 
         # Old manual kludge...
         # selected_names = [ 'AB-002+10003' ]
@@ -145,34 +577,32 @@ def monkeypatch(cls):
 def display(self, audit):
     "Return a string describing a ballot and the choices marked on it"
 
-    ballotID = self['BallotID']
-    m = ballotIDre.match(ballotID)
-    image = int(m.group('image'))
-    show = "%s #%d (%s):\n" % (ballotID, (image - 10000) / 2, self['BallotStyleID'])
+    image = self['Image']
+    show = "%s #%d (%s):\n" % (ballot_id(self), (image - 10000) / 2, self['BallotStyleID'])
 
     results = []
     contest = -1
     contest_voted = True	# Avoid saying there's an missing vote for fake contest -1
-    for choiceid in self.index[5:]:	# FIXME: don't rely on Choices starting at index 5
-        if not math.isnan(self[choiceid]):
-            if contest != audit.choiceid_contest[choice_num(choiceid)]:
+    for choiceid, choice_contest, choice_line in zip(audit.choice_columns, audit.column_contest, audit.column_choice_line):
+        if not pd.isnull(self[choiceid]):
+            if contest != choice_contest:
                 # We're coming across a new contest.  If last one wasn't voted, record that.
                 if not contest_voted:
                     results.append("  invalid vote for %s" % audit.contestid_name[contest])
-                contest = audit.choiceid_contest[choice_num(choiceid)]
+                contest = choice_contest
                 contest_voted = False
                 results.append(" %d: %s" % (contest, audit.contestid_name[contest]))
                 
             if self[choiceid] == 1:
                 contest_voted = True
-                results.append("  %s" % audit.choiceid_name[choice_num(choiceid)])
+                results.append(choice_line[:-1])
 
     return(show + "\n".join(results))
 
 @monkeypatch(pd.Series)
 def batch_name(self, audit):
     "Return just the batch name of a ballot"
-    return self['BallotID'][0:5]
+    return "%s-%s" % (self['BallotType'], self['Batch'])
 
 class Choice():
     def __init__(self, choice):
@@ -205,16 +635,52 @@ def main(parser):
 
     logging.debug("options: %s; args: %s", options, args)
 
+    if options.test:
+        import doctest
+        doctest.testmod()
+        sys.exit(0)
+
     # Parse the CBG data
-    audit = Audit(options.prefix, options.manifest)
+    contests = None
+    if options.contests:
+        contests = [int(c) for c in options.contests.split(",")]
+
+    winners = {}
+    if options.winners:
+        winners = dict((int(c), int(w)) for c, w in (pair.split(":") for pair in options.winners.split(",")))
+        if min(winners.values()) < 1:
+            parser.error("Each contest in --winners needs at least 1 winner")
+
+    audit = Audit(options.prefix, options.manifest, contests, options.chunksize, options.jobs)
+
+    if options.tally or (options.seed and not options.N):
+        choice_totals, contest_totals = audit.tally(winners, options.risk / 100.0)
+
+    if options.tally:
+        with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', 200):
+            print(choice_totals.to_string(index=False))
+            print("")
+            print(contest_totals.to_string(index=False))
+
+    if options.seed and not options.N:
+        if contests is not None:
+            contest_totals = contest_totals[contest_totals['ContestID'].isin(contests)]
+        if contest_totals['SampleSize'].isnull().all():
+            parser.error("Can't calculate a sample size from the margins.  Specify a number of ballots with -n")
+        options.N = int(contest_totals['SampleSize'].max())
+        logging.warning("Selecting %d ballots, the expected sample size for a %g%% risk limit" % (options.N, options.risk))
+
+    if options.write_manifest:
+        audit.ballot_manifest.write(options.write_manifest)
 
     if options.seed:
         audit.select_ballots(options.seed, options.N)
 
-        i = 0
-        for id, s in audit.selected.iterrows():
-            i += 1
-            print("\n%d: %s" % (i, s.display(audit)))
+        if options.json:
+            print(json.dumps(audit.render(audit.selected, 'json'), indent=1))
+        else:
+            for i, text in enumerate(audit.render(audit.selected)):
+                print("\n%d: %s" % (i + 1, text))
 
 if __name__ == "__main__":
     main(parser)
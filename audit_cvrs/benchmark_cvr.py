@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+"""Benchmark the memory used to look up CVRs in a synthetic ES&S CVR file.
+
+%InsertOptionParserUsage%
+
+Each method is measured in a fresh process, as the growth in peak resident memory
+from loading the file, along with the time taken:
+
+ dict:  the original representation, a dict of an OrderedDict per row
+ table: read_ess_cvr, a compact CVRTable in memory
+ store: CVRStore, an index of byte offsets into a memory-mapped file
+"""
+
+import os
+import csv
+import sys
+import time
+import random
+import logging
+import resource
+import tempfile
+import optparse
+import subprocess
+from collections import OrderedDict
+
+import cvr
+
+METHODS = ('dict', 'table', 'store')
+
+parser = optparse.OptionParser(prog="benchmark_cvr.py", usage="Usage: %prog [options]")
+
+parser.add_option("-n", "--rows", type="int", default=1000000,
+  help="number of CVRs in the synthetic file, default 1000000" )
+
+parser.add_option("-c", "--contests", type="int", default=60,
+  help="number of contest columns, default 60" )
+
+parser.add_option("-f", "--file",
+  help="use or create this synthetic CVR file, rather than a temporary one" )
+
+parser.add_option("--measure", choices=METHODS,
+  help="internal: measure the given method on the given file" )
+
+# incorporate OptionParser usage documentation into our docstring
+__doc__ = __doc__.replace("%InsertOptionParserUsage%\n", parser.format_help())
+
+def write_synthetic(path, rows, contests, seed=1):
+    """Write a synthetic ES&S-style CVR file, with the same leading columns as test/ess-test.cvr.
+    Each of 20 ballot styles includes a random quarter of the contests, and other fields are blank."""
+
+    rng = random.Random(seed)
+    choices = ['Candidate %d' % i for i in range(5)] + ['undervote', 'YES', 'NO']
+    styles = [sorted(rng.sample(range(contests), contests // 4)) for i in range(20)]
+
+    with open(path, 'w') as f:
+        f.write(','.join(['seqno', 'Cast Vote Record', 'Style', 'Serial Number', 'BoxNum', 'BoxPosition'] +
+                         ['CONTEST %d' % i for i in range(contests)]) + '\n')
+
+        for seqno in range(1, rows + 1):
+            style = rng.randrange(len(styles))
+            fields = [''] * contests
+            for i in styles[style]:
+                fields[i] = rng.choice(choices)
+            f.write(','.join([str(seqno), str(80000 + seqno), str(style), str(166000000 + seqno),
+                              'P%d' % (seqno // 500), str(seqno % 500 + 1)] + fields) + '\n')
+
+def load(method, path):
+    "Load the CVRs in the given file by the given method, and return a lookup function"
+
+    if method == 'dict':
+        with open(path, 'rU') as data:
+            reader = csv.DictReader(data)
+            cvrs = dict((str(seqno), OrderedDict((f, row[f]) for f in reader.fieldnames))
+                        for seqno, row in enumerate(reader))
+        return lambda id: '\n'.join("%s: %s" % (key, value) for key, value in cvrs[id].items() if value)
+
+    cvr.init(path, in_memory=(method == 'table'))
+    return cvr.lookup_cvr
+
+def measure(method, path):
+    "Print the growth in peak memory, in MB, and the seconds taken to load the CVRs and look one up"
+
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    lookup = load(method, path)
+    lookup('1')
+    elapsed = time.time() - start
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is in kilobytes on Linux, bytes on Mac OS X
+    scale = 1024.0 * 1024 if sys.platform == 'darwin' else 1024.0
+    print("%.1f %.2f" % ((after - before) / scale, elapsed))
+
+def main(parser):
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    if options.measure:
+        measure(options.measure, options.file)
+        return
+
+    path = options.file
+    if path is None:
+        fd, path = tempfile.mkstemp(suffix='.cvr')
+        os.close(fd)
+    if options.file is None or not os.path.exists(path):
+        write_synthetic(path, options.rows, options.contests)
+
+    print("%d MB file %s" % (os.path.getsize(path) // (1024 * 1024), path))
+    print("method  peak MB  seconds")
+    try:
+        for method in METHODS:
+            try:
+                output = subprocess.check_output([sys.executable, __file__, '--measure', method, '--file', path])
+            except subprocess.CalledProcessError as e:
+                print("%-6s failed with exit status %d, e.g. killed when out of memory" % (method, e.returncode))
+                continue
+            megabytes, seconds = output.split()[-2:]
+            print("%-6s %8s %8s" % (method, megabytes, seconds))
+    finally:
+        if options.file is None:
+            for filename in (path, cvr.index_filename(path)):
+                if os.path.exists(filename):
+                    os.remove(filename)
+
+if __name__ == "__main__":
+    main(parser)
@@ -0,0 +1,105 @@
+"""
+Checkpoints for resuming long-running parses of large CVR exports.
+
+The state is pickled to a temporary file, synced to disk, and then renamed over
+the checkpoint file, so a checkpoint is always either the old one or the new one,
+never a partial write.  The identity of the input (e.g. file name, size and mtime)
+is saved along with it, so a checkpoint is only used to resume the same parse.
+
+>>> import os, tempfile
+>>> filename = os.path.join(tempfile.mkdtemp(), "parse.checkpoint")
+>>> c = Checkpoint(filename, interval=0, identity=("export.zip", 1234))
+>>> c.load() is None
+True
+>>> c.save({'n': 42, 'completed': ['CvrExport_0.json']})
+>>> Checkpoint(filename, identity=("export.zip", 1234)).load()['n']
+42
+>>> try:
+...     Checkpoint(filename, identity=("other.zip", 99)).load()
+... except CheckpointError as e:
+...     print("Error: %s" % e)
+Error: checkpoint ... is for a different input: ('export.zip', 1234)
+>>> c.remove()
+>>> os.path.exists(filename)
+False
+"""
+
+import os
+import time
+import pickle
+import tempfile
+import logging
+
+
+class CheckpointError(Exception):
+    pass
+
+
+def file_identity(filename):
+    "Return a tuple identifying the given file and its current contents: path, size and mtime"
+
+    st = os.stat(filename)
+    return (os.path.abspath(filename), st.st_size, int(st.st_mtime))
+
+
+class Checkpoint(object):
+    "Atomically save and restore the state of a parse, at most once per interval seconds"
+
+    def __init__(self, filename, interval=60.0, identity=None):
+        self.filename = filename
+        self.interval = interval
+        self.identity = identity
+        self.last_save = time.time()
+
+    def due(self):
+        "Return True if it has been at least interval seconds since the last save"
+
+        return time.time() - self.last_save >= self.interval
+
+    def load(self):
+        "Return the saved state, or None if there is no checkpoint"
+
+        if not os.path.exists(self.filename):
+            return None
+
+        with open(self.filename, 'rb') as f:
+            identity, state = pickle.load(f)
+
+        if identity != self.identity:
+            raise CheckpointError("checkpoint %s is for a different input: %s" % (self.filename, identity))
+
+        logging.info("Resuming from checkpoint %s" % self.filename)
+        return state
+
+    def save(self, state):
+        "Atomically replace the checkpoint with the given state"
+
+        # A temporary file of our own, as for CVRStore.save_index, so parses sharing a checkpoint don't clash
+        fd, tmpname = tempfile.mkstemp(prefix=os.path.basename(self.filename) + '.', suffix='.tmp',
+                                       dir=os.path.dirname(os.path.abspath(self.filename)))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((self.identity, state), f, pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+
+            if os.name == 'nt' and os.path.exists(self.filename):
+                os.remove(self.filename)
+            os.rename(tmpname, self.filename)
+        except:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+            raise
+
+        self.last_save = time.time()
+        logging.info("Saved checkpoint %s" % self.filename)
+
+    def remove(self):
+        "Remove the checkpoint, e.g. after the parse has completed"
+
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+if __name__ == '__main__':
+     import doctest
+     doctest.testmod(optionflags=doctest.ELLIPSIS)
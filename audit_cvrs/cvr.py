@@ -1,38 +1,615 @@
 #!/usr/bin/env python
-"read in and cache csv file of Cast Vote Records, looking up sequential ids in 'seqno' column"
+"""read in and cache csv file of Cast Vote Records, looking up sequential ids in 'seqno' column
 
+CVRs are looked up via a CVRStore: an index of the byte offset of each record in the csv
+file, which is memory-mapped so that only the requested row is read and decoded.
+Memory use is 8 bytes per CVR for the index, regardless of how wide the rows are.
+Alternatively, read_ess_cvr reads all the CVRs into a compact CVRTable in memory.
+
+The index is saved next to the csv file, e.g. cvr.csv.index, along with the file's path,
+size, mtime and content hash, so later processes can just load it.  It is only rebuilt
+when the csv file changes.  init() just notes the file name, and the store is opened
+lazily on the first lookup, so server startup is quick.
+
+CVRs can also be found by the other identifiers auditors may have at hand, via find_cvr()
+or lookup_cvr_by(): a ballot id or serial number, a Dominion (tabulator, batch, record)
+triple, or a box and position in it.  See KEY_COLUMNS.
+
+The rendered text of recently looked up CVRs is kept in an LRUCache, which can be warmed
+up for the whole sample right after selection via warm_cache().
+
+>>> import os
+>>> store = CVRStore(os.path.join(os.path.dirname(__file__), '../test/ess-test.cvr'), index=False)
+>>> len(store)
+100
+>>> store.row(1)[:6]
+['2', '82778', '6', '166008947', 'P5', '2']
+>>> table = read_ess_cvr(os.path.join(os.path.dirname(__file__), '../test/ess-test.cvr'))
+>>> table.items(1) == store.items(1)
+True
+>>> store.find('serial', '166008947'), table.find('box', 'P5', '2')
+(1, 1)
+"""
+
+import os
 import csv
+import mmap
+import time
+import pickle
+import bisect
+import hashlib
 import logging
+import tempfile
+import threading
+from array import array
 from collections import OrderedDict
 
+from checkpoint import file_identity
+from manifest import batch_label
+
 #ESS_CVR_FILE = "/srv/voting/audit/corla/pilot-cvr-lat/ES&S/Jefferson/2nd Submission/IncompleteJeffcoCastVoteRecord.csv"
 #CVR_FILE = "/srv/voting/audit/corla/jeffco-2015/box-list-final.csv"
 CVR_FILE = "/srv/voting/audit/corla/dominion/cvr-export-recommendation/cvr.csv"
 
-CVRS = {}
+INDEX_VERSION = 4
+
+# Columns identifying a CVR for each kind of key, in the csv formats we know.
+# The first set of columns which are all in the header is used.
+# For a box key from TabulatorId and BatchId, the box is the batch label, e.g. 2-15, and the
+# position is counted in file order, as in the lookup files from parse_dominion_cvrs.py.
+KEY_COLUMNS = [
+    ('ballot_id', [('Cast Vote Record',), ('BallotID',)]),                  # ES&S, Clear Ballot
+    ('serial', [('Serial Number',)]),                                       # ES&S imprinted serial number
+    ('record', [('TabulatorId', 'BatchId', 'RecordId')]),                   # Dominion
+    ('box', [('BoxNum', 'BoxPosition'), ('TabulatorId', 'BatchId')]),       # box and position in it
+]
+
+STORE = None
+CVR_PATH = None
+IN_MEMORY = False
+
+# Count of stores opened, so cached CVR text is keyed by the store it was rendered from
+GENERATION = 0
+
+# Held while changing the store, as lookups come from the threads of a threaded server
+STORE_LOCK = threading.Lock()
+
+# Number of rendered CVRs to cache: more than the largest expected sample
+CACHE_SIZE = 10000
+
+# Seconds between checks of whether the CVR file has changed
+CHECK_INTERVAL = 1.0
+LAST_CHECK = 0.0
+
+class CVRTable(object):
+    """CVRs held compactly in memory: one shared header, and for each row a tuple of the
+    column numbers of its non-blank fields (a sparse index) and a tuple of their values.
+
+    Column tuples, typically one per ballot style, are shared between rows.  So are the values
+    in each column, e.g. candidate names, until a column has more than max_interned distinct
+    values, as for serial numbers.
+
+    >>> table = CVRTable(['seqno', 'Style', 'Mayor', 'Clerk'])
+    >>> table.append(['1', '6', 'Kris', ''])
+    >>> table.append(['2', '6', 'Kris', ''])
+    >>> table.rows[1]
+    ((0, 1, 2), ('2', '6', 'Kris'))
+    >>> table.rows[0][0] is table.rows[1][0], table.rows[0][1][2] is table.rows[1][1][2]
+    (True, True)
+    >>> table.row(1)
+    ['2', '6', 'Kris', '']
+    """
+
+    def __init__(self, header, max_interned=1000):
+        self.header = tuple(header)
+        self.max_interned = max_interned
+        self.rows = []
+        self._columns = {}
+        self._values = [{} for h in self.header]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def append(self, fields):
+        "Add a row, given the list of its fields"
+
+        columns = tuple(i for i, value in enumerate(fields[:len(self.header)]) if value)
+        columns = self._columns.setdefault(columns, columns)
+
+        values = []
+        for i in columns:
+            value = fields[i]
+            interned = self._values[i]
+            if interned is not None:
+                value = interned.setdefault(value, value)
+                if len(interned) > self.max_interned:
+                    self._values[i] = None
+            values.append(value)
+
+        self.rows.append((columns, tuple(values)))
+
+    def _row(self, seqno):
+        if not 0 <= seqno < len(self.rows):
+            raise KeyError(seqno)
+        return self.rows[seqno]
+
+    def items(self, seqno):
+        "Return a list of (column name, value) for the non-blank fields of the CVR with the given 0-based sequential id"
+
+        columns, values = self._row(seqno)
+        return [(self.header[i], value) for i, value in zip(columns, values)]
+
+    def row(self, seqno):
+        "Return the list of fields in the CVR with the given 0-based sequential id"
+
+        fields = [''] * len(self.header)
+        columns, values = self._row(seqno)
+        for i, value in zip(columns, values):
+            fields[i] = value
+        return fields
+
+    def find(self, kind, *key):
+        "Return the sequential id of the CVR with the given key of the given kind, checking its fields"
+
+        return self.keys.find(kind, key, self.row)
 
 def read_ess_cvr(path):
+    "Read all the CVRs in the given csv file into a CVRTable, indexing their keys in the same pass"
+
     with open(path, 'rU') as data:
-        reader = csv.DictReader(data)
+        reader = csv.reader(data)
+        table = CVRTable(next(reader))
+        table.keys = CVRKeys(table.header)
+        for seqno, fields in enumerate(reader):
+            table.append(fields)
+            table.keys.add(seqno, fields)
+
+    table.keys.finish()
+    return table
+
+# Bytes in each key hash, the same on every platform
+HASH_BYTES = 8
+
+def key_hash(key):
+    "Return a hash of a tuple of strings as a byte string of HASH_BYTES bytes, the same in every process"
+
+    return hashlib.md5(b'\0'.join(key)).digest()[:HASH_BYTES]
+
+class HashArray(object):
+    "A read-only sequence of the hashes packed in a byte string, in the order of their bytes, for bisection"
+
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data) // HASH_BYTES
+
+    def __getitem__(self, i):
+        return self.data[i * HASH_BYTES:(i + 1) * HASH_BYTES]
+
+class DuplicateKeyError(KeyError):
+    "Raised when more than one CVR has the key being looked up"
+
+class CVRKeys(object):
+    """Secondary indexes from the keys of each kind in KEY_COLUMNS to 0-based sequential ids.
+
+    Each index is a sorted byte string of key hashes, and an array of the matching sequential ids,
+    searched by bisection: 12 bytes per CVR per kind of key, and quick to save and load.
+    Hashes can collide, and keys can be duplicated, e.g. by a rescanned Dominion record,
+    so every CVR with the hash of the key is checked against the key, given a way to read its fields.
+
+    >>> keys = CVRKeys(['TabulatorId', 'BatchId', 'RecordId'])
+    >>> rows = [['2', '15', '1'], ['2', '15', '3'], ['2', '16', '1'], ['2', '15', '3']]
+    >>> for seqno, fields in enumerate(rows[:3]):
+    ...     keys.add(seqno, fields)
+    >>> keys.finish()
+    >>> keys.find('record', ('2', '15', '3'), rows.__getitem__), keys.find('box', ('2-16', '1'), rows.__getitem__)
+    (1, 2)
+    >>> keys.add(3, rows[3])
+    >>> keys.finish()
+    >>> keys.find('record', ('2', '15', '3'), rows.__getitem__)
+    Traceback (most recent call last):
+    DuplicateKeyError: 'CVRs 1, 3 all have record 2, 15, 3'
+    """
+
+    def __init__(self, header):
+        self.columns = {}
+        for kind, choices in KEY_COLUMNS:
+            for names in choices:
+                if all(name in header for name in names):
+                    self.columns[kind] = [header.index(name) for name in names]
+                    break
+
+        # Count ballots in each batch, for box keys with positions counted in file order
+        self.counted = 'box' in self.columns and len(self.columns['box']) == 2 and header[self.columns['box'][1]] == 'BatchId'
+        self.batch_counts = {} if self.counted else None
+
+        self.hashes = dict((kind, bytearray()) for kind in self.columns)
+        self.seqnos = dict((kind, array('I')) for kind in self.columns)
+
+    def key(self, kind, fields):
+        "Return the key of the given kind for the CVR with the given fields, or None if it is missing"
+
+        try:
+            key = tuple(fields[i] for i in self.columns[kind])
+        except IndexError:
+            return None
+
+        if kind == 'box' and self.batch_counts is not None:
+            count = self.batch_counts[key] = self.batch_counts.get(key, 0) + 1
+            key = (batch_label(*key), str(count))
+
+        return key
+
+    def matches(self, kind, key, fields):
+        """Return whether the CVR with the given fields has the given key of the given kind.
+        Only the box of a position counted in file order can be checked."""
+
+        try:
+            stored = tuple(fields[i] for i in self.columns[kind])
+        except IndexError:
+            return False
+
+        if kind == 'box' and self.counted:
+            return batch_label(*stored) == key[0]
+        return stored == tuple(key)
+
+    def add(self, seqno, fields):
+        "Add the keys of the CVR with the given sequential id and fields"
+
+        for kind in self.columns:
+            key = self.key(kind, fields)
+            if key is not None:
+                self.hashes[kind] += key_hash(key)
+                self.seqnos[kind].append(seqno)
+
+    def finish(self):
+        "Sort the indexes, once all the CVRs have been added"
+
+        for kind in self.columns:
+            hashes, seqnos = HashArray(bytes(self.hashes[kind])), self.seqnos[kind]
+            order = sorted(range(len(hashes)), key=hashes.__getitem__)
+            self.hashes[kind] = bytearray(b''.join(hashes[i] for i in order))
+            self.seqnos[kind] = array('I', (seqnos[i] for i in order))
+
+        self.batch_counts = None
+
+    def find(self, kind, key, row=None):
+        """Return the sequential id of the CVR with the given key (a tuple) of the given kind.
+        Check each CVR with the same key hash via row(seqno), if given, which returns its fields.
+        Raise KeyError if there is none, or DuplicateKeyError if there is more than one."""
+
+        if kind not in self.columns:
+            raise KeyError("No %s keys in these CVRs" % kind)
+
+        hashes = HashArray(self.hashes[kind])
+        h = key_hash(key)
+        seqnos = []
+        i = bisect.bisect_left(hashes, h)
+        while i < len(hashes) and hashes[i] == h:
+            seqno = int(self.seqnos[kind][i])
+            if row is None or self.matches(kind, key, row(seqno)):
+                seqnos.append(seqno)
+            i += 1
+
+        if not seqnos:
+            raise KeyError("No CVR with %s %s" % (kind, ", ".join(key)))
+        if len(seqnos) > 1:
+            raise DuplicateKeyError("CVRs %s all have %s %s" % (", ".join(map(str, sorted(seqnos))), kind, ", ".join(key)))
+
+        return seqnos[0]
+
+    def __getstate__(self):
+        "Pickle the indexes as plain byte strings, which is much faster, and portable"
+
+        state = self.__dict__.copy()
+        state['hashes'] = dict((kind, bytes(data)) for kind, data in state['hashes'].items())
+        state['seqnos'] = dict((kind, getattr(a, 'tobytes', a.tostring)()) for kind, a in state['seqnos'].items())
+        return state
+
+    def __setstate__(self, state):
+        state['hashes'] = dict((kind, bytearray(data)) for kind, data in state['hashes'].items())
+        seqnos = {}
+        for kind, data in state['seqnos'].items():
+            seqnos[kind] = array('I')
+            getattr(seqnos[kind], 'frombytes', seqnos[kind].fromstring)(data)
+        state['seqnos'] = seqnos
+        self.__dict__.update(state)
+
+def content_hash(path, blocksize=1024 * 1024):
+    "Return the sha1 hex digest of the contents of the given file"
+
+    hasher = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+def index_filename(path):
+    "Return the name of the file holding the prebuilt index of the given CVR file"
+
+    return path + '.index'
+
+def record_offsets(f, hasher=None, keys=None):
+    """Return an array of the byte offset of each record in the given binary csv file,
+    starting from its current position, followed by the offset of the end of the file.
+    Fields may contain quoted newlines: a record only ends at a newline outside quotes.
+    Update the given hasher, if any, with each line, and add each record to the given CVRKeys, if any."""
+
+    offsets = array('L')
+    offset = f.tell()
+    inquote = False
+    lines = []
+    if keys is not None and not keys.columns:
+        keys = None
+
+    for line in iter(f.readline, b''):
+        if hasher:
+            hasher.update(line)
+        if not inquote:
+            offsets.append(offset)
+        inquote ^= line.count(b'"') % 2 == 1
+        offset += len(line)
+
+        if keys is not None:
+            lines.append(line)
+            if not inquote:
+                keys.add(len(offsets) - 1, next(csv.reader(lines)))
+                lines = []
+
+    offsets.append(offset)
+    return offsets
+
+class CVRStore(object):
+    """CVRs in a csv file, looked up by 0-based sequential id via an index of byte offsets.
+    Only the requested row is decoded, from a read-only memory map of the file.
+
+    With index, load the prebuilt index if it matches the file, or else build and save it.
+    """
+
+    def __init__(self, path, index=True):
+        self.path = path
+        self.identity = file_identity(path)
+
+        with open(path, 'rb') as f:
+            if not (index and self.load_index()):
+                headerline = f.readline()
+                hasher = hashlib.sha1(headerline)
+                self.header = next(csv.reader([headerline]))
+                self.keys = CVRKeys(self.header)
+                self.offsets = record_offsets(f, hasher, self.keys)
+                self.keys.finish()
+                self.digest = hasher.hexdigest()
+                logging.info("Indexed %d CVRs in %s" % (len(self), path))
+                if index:
+                    self.save_index()
+
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def load_index(self):
+        """Load the prebuilt index, and return True if it is for this file as it is now.
+        If just the mtime has changed, e.g. after a copy, check the content hash instead."""
+
+        filename = index_filename(self.path)
+        if not os.path.exists(filename):
+            return False
+
+        try:
+            with open(filename, 'rb') as f:
+                version, identity, digest, header, typecode, offsets, keys = pickle.load(f)
+        except Exception as e:
+            logging.warning("Ignoring unreadable CVR index %s: %s" % (filename, e))
+            return False
+
+        if version != INDEX_VERSION or identity[:2] != self.identity[:2]:
+            return False
+
+        if identity != self.identity:
+            if content_hash(self.path) != digest:
+                return False
+            logging.info("CVR file %s has a new mtime but the same contents" % self.path)
+
+        self.header = header
+        self.keys = CVRKeys.__new__(CVRKeys)
+        self.keys.__setstate__(keys)
+        self.offsets = array(typecode)
+        getattr(self.offsets, 'frombytes', self.offsets.fromstring)(offsets)
+        self.digest = digest
+
+        if identity != self.identity:
+            self.save_index()
+
+        logging.info("Loaded index of %d CVRs from %s" % (len(self), filename))
+        return True
+
+    def save_index(self):
+        "Atomically save the index, keyed by the identity and content hash of the file, if we can"
+
+        filename = index_filename(self.path)
+        offsets = getattr(self.offsets, 'tobytes', self.offsets.tostring)()
+        tmpname = None
+        try:
+            # A temporary file of our own, so processes indexing the same file at once don't clash
+            fd, tmpname = tempfile.mkstemp(prefix=os.path.basename(filename) + '.', suffix='.tmp',
+                                           dir=os.path.dirname(os.path.abspath(filename)))
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((INDEX_VERSION, self.identity, self.digest, self.header, self.offsets.typecode, offsets, self.keys.__getstate__()),
+                            f, pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(tmpname, 0o644)    # mkstemp makes it private, but e.g. the server may run as another user
+            if os.name == 'nt' and os.path.exists(filename):
+                os.remove(filename)
+            os.rename(tmpname, filename)
+        except (IOError, OSError) as e:
+            logging.warning("Can't save CVR index %s: %s" % (filename, e))
+            if tmpname and os.path.exists(tmpname):
+                os.remove(tmpname)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def row(self, seqno):
+        "Return the list of fields in the CVR with the given 0-based sequential id"
+
+        if not 0 <= seqno < len(self):
+            raise KeyError(seqno)
+
+        data = self.map[self.offsets[seqno]:self.offsets[seqno + 1]]
+        return next(csv.reader(data.splitlines(True)))
+
+    def items(self, seqno):
+        "Return a list of (column name, value) for the non-blank fields of the CVR with the given 0-based sequential id"
+
+        return [(key, value) for key, value in zip(self.header, self.row(seqno)) if value]
+
+    def find(self, kind, *key):
+        "Return the sequential id of the CVR with the given key of the given kind, checking its fields"
+
+        return self.keys.find(kind, key, self.row)
+
+class LRUCache(object):
+    """A cache of at most maxsize values, discarding the least recently used, with counts of hits and misses.
+    It can be shared between threads.  Values are computed outside the lock, so two threads may both compute one.
+
+    >>> cache = LRUCache(2)
+    >>> [cache.get(key, str.upper) for key in ['a', 'b', 'a', 'c', 'b']]
+    ['A', 'B', 'A', 'C', 'B']
+    >>> (cache.hits, cache.misses, list(cache.data))
+    (1, 4, ['c', 'b'])
+    """
+
+    def __init__(self, maxsize=CACHE_SIZE):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, compute):
+        "Return the cached value for key, or cache and return compute(key)"
+
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+                self.hits += 1
+                self.data[key] = value
+                return value
+            except KeyError:
+                self.misses += 1
+
+        value = compute(key)
+        self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        "Cache value for key, as the most recently used"
+
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __str__(self):
+        return "%d hits, %d misses, %d of %d cached" % (self.hits, self.misses, len(self.data), self.maxsize)
+
+CACHE = LRUCache()
+
+def init(cvrfilename = CVR_FILE, in_memory=False):
+    """Use the given CVR file for lookups, opened lazily by get_store() on the first lookup:
+    as a CVRStore, or with in_memory, reading it all into a CVRTable"""
+
+    global STORE, CVR_PATH, IN_MEMORY
+
+    with STORE_LOCK:
+        STORE = None
+        CACHE.clear()
+        CVR_PATH = cvrfilename
+        IN_MEMORY = in_memory
+
+def get_store():
+    "Return the store of CVRs, opening it if need be, or reopening it if the file has changed"
+
+    global STORE, LAST_CHECK, GENERATION
+
+    store = STORE
+    if store is not None and time.time() - LAST_CHECK < CHECK_INTERVAL:
+        return store
+
+    with STORE_LOCK:
+        changed = False
+        if STORE is not None and time.time() - LAST_CHECK >= CHECK_INTERVAL:
+            changed = file_identity(CVR_PATH) != STORE.identity
+            LAST_CHECK = time.time()
+
+        if STORE is None or changed:
+            if IN_MEMORY:
+                identity = file_identity(CVR_PATH)
+                store = read_ess_cvr(CVR_PATH)
+                store.identity = identity
+            else:
+                store = CVRStore(CVR_PATH)
+
+            GENERATION += 1
+            store.generation = GENERATION
+            STORE = store
+            CACHE.clear()
+            print("Read in %d CVRs" % len(STORE))
+            logging.debug("Read in %d CVRs" % len(STORE))
+
+        return STORE
+
+def render_cvr(store, seqno):
+    "Return the text of the CVR with the given 0-based sequential id in store: 'key: value' lines for each non-blank field"
+
+    return '\n'.join(("%s: %s" % (key, value) for key, value in store.items(seqno)))
+
+def lookup_seqno(seqno):
+    """Return the text of the CVR with the given 0-based sequential id, via the cache.
+    It is rendered from and cached under the store get_store() returns, so text from
+    a store that has since been reopened is never cached, nor found, under the new one."""
+
+    store = get_store()
+    return CACHE.get((store.generation, seqno), lambda key: render_cvr(store, seqno))
+
+def lookup_cvr(ballot):
+    """Return the text of the CVR with the given 1-based ballot number, as in lookup files and
+    ballot manifests: the number of the row in the CVR file after the header.
+    This is the one place ballot numbers are converted to 0-based sequential ids."""
+
+    seqno = int(ballot) - 1
+    if seqno < 0:
+        raise KeyError(ballot)
+    return lookup_seqno(seqno)
 
-        for seqno, row in enumerate(reader):
-            yield (str(seqno), OrderedDict( (f, row[f]) for f in reader.fieldnames))
+def warm_cache(ballots):
+    """Render and cache the CVRs with the given ballot numbers, e.g. for the whole sample right after selection.
+    If there are more than fit in the cache, just warm it for the first ones."""
 
-def init(cvrfilename = CVR_FILE):
+    if len(ballots) > CACHE.maxsize:
+        logging.warning("Sample of %d CVRs is bigger than the CVR cache: only warming it for the first %d" % (len(ballots), CACHE.maxsize))
+        ballots = ballots[:CACHE.maxsize]
 
-    # print read_ess_cvr(cvrfilename).next()
-    global CVRS
+    for ballot in ballots:
+        lookup_cvr(ballot)
 
-    CVRS = dict(list(read_ess_cvr(cvrfilename)))
+    logging.info("Warmed CVR cache for %d CVRs: %s" % (len(ballots), CACHE))
 
-    print("Read in %d CVRs" % len(CVRS))
-    logging.debug("Read in %d CVRs" % len(CVRS))
+def find_cvr(kind, *key):
+    """Return the 0-based sequential id of the CVR with the given key of the given kind,
+    e.g. find_cvr('serial', '166008947') or find_cvr('record', '2', '15', '3')"""
 
-def lookup_cvr(id):
+    return get_store().find(kind, *key)
 
-    global CVRS
+def lookup_cvr_by(kind, *key):
+    "Return the text of the CVR with the given key of the given kind, as for find_cvr"
 
-    return '\n'.join(("%s: %s" % (key, value) for key, value in CVRS[id].iteritems() if value))
+    return lookup_seqno(find_cvr(kind, *key))
 
 
 if __name__ == "__main__":
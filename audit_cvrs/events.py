@@ -0,0 +1,123 @@
+"""
+A small in-process hub which fans out events, e.g. changes to CVRs, to subscribers
+such as the server-sent event streams of the auditor stations.
+
+Each subscriber has its own bounded queue, so publishing never waits for a slow
+subscriber: one which falls too far behind is marked as having missed events, and
+should start over, e.g. by reloading its page.  Recent events are kept, so a stream
+which reconnects with the id of the last event it saw can resume from there.
+
+The hub only reaches subscribers in the same process, which suits the single
+(multi-threaded) Django server process which the auditor stations share.
+
+>>> hub = Hub(history=2)
+>>> s = hub.subscribe()
+>>> hub.publish('cvr', {'id': 1})
+1
+>>> s.get(timeout=0)
+[(1, 'cvr', {'id': 1})]
+>>> hub.publish('cvr', {'id': 2}), hub.publish('cvr', {'id': 3})
+(2, 3)
+>>> [id for id, kind, data in s.get(timeout=0)]
+[2, 3]
+>>> [id for id, kind, data in hub.subscribe(last_id=1).get(timeout=0)]
+[2, 3]
+>>> hub.subscribe(last_id=0).missed
+True
+>>> print(format_event(3, 'cvr', {'id': 3}).strip())
+id: 3
+event: cvr
+data: {"id": 3}
+"""
+
+import json
+import Queue
+import threading
+import collections
+
+
+class Subscription(object):
+    "A queue of events for one subscriber"
+
+    def __init__(self, maxsize):
+        self.queue = Queue.Queue(maxsize)
+        self.missed = False
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except Queue.Full:
+            self.missed = True
+
+    def get(self, timeout):
+        "Wait up to timeout seconds for an event, and return a list of all the events which are waiting"
+
+        events = []
+        try:
+            events.append(self.queue.get(timeout > 0, timeout))
+            while True:
+                events.append(self.queue.get_nowait())
+        except Queue.Empty:
+            pass
+        return events
+
+
+class Hub(object):
+    "Publish numbered events to all current subscribers, keeping the most recent history events"
+
+    def __init__(self, history=1000, maxsize=1000):
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        self.history = collections.deque(maxlen=history)
+        self.maxsize = maxsize
+        self.last_id = 0
+
+    def subscribe(self, last_id=None):
+        """Return a new Subscription.  If last_id is given, start it with the later events in the
+        history, or mark it as having missed events if they are no longer all in the history."""
+
+        subscription = Subscription(self.maxsize)
+        with self.lock:
+            if last_id is not None:
+                oldest = self.history[0][0] if self.history else self.last_id + 1
+                if last_id > self.last_id or last_id < oldest - 1:
+                    subscription.missed = True
+                for event in self.history:
+                    if event[0] > last_id:
+                        subscription.put(event)
+            self.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscribers.discard(subscription)
+
+    def publish(self, kind, data):
+        "Send an event of the given kind, with the given json-serializable data, to all subscribers, and return its id"
+
+        with self.lock:
+            self.last_id += 1
+            event = (self.last_id, kind, data)
+            self.history.append(event)
+            for subscription in self.subscribers:
+                subscription.put(event)
+        return self.last_id
+
+
+def format_event(id, kind, data):
+    "Return the text of a server-sent event, with data as json"
+
+    lines = []
+    if id is not None:
+        lines.append("id: %d" % id)
+    lines.append("event: %s" % kind)
+    lines.append("data: %s" % json.dumps(data, sort_keys=True))
+    return "\n".join(lines) + "\n\n"
+
+
+# The hub for this process
+HUB = Hub()
+
+if __name__ == '__main__':
+     import doctest
+     doctest.testmod()
@@ -0,0 +1,50 @@
+import json
+import time
+from django.core.management.base import BaseCommand
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from optparse import make_option
+from reversion.models import Version
+from audit_cvrs.models import CVR, CVRVersionAdapter
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("--batch_size", type="int", default=1000,
+          help="number of versions to rewrite per transaction, default 1000" ),
+        make_option("-n", "--dry-run", action="store_true", default=False,
+          help="report the savings without changing the database" ),
+        )
+    help = ("Remove the fields which versions no longer include, e.g. cvr_text, from CVR versions saved before they were excluded")
+
+    def handle(self, *args, **options):
+        exclude = CVRVersionAdapter.exclude
+        versions = Version.objects.filter(content_type=ContentType.objects.get_for_model(CVR), format="json")
+
+        start = time.time()
+        count = compacted = before = after = 0
+        last = 0
+        while True:
+            batch = list(versions.filter(pk__gt=last).order_by('pk').only('pk', 'serialized_data')[:options['batch_size']])
+            if not batch:
+                break
+            last = batch[-1].pk
+
+            with transaction.atomic():
+                for version in batch:
+                    count += 1
+                    data = json.loads(version.serialized_data)
+                    fields = data[0]['fields']
+                    if not any(field in fields for field in exclude):
+                        continue
+
+                    for field in exclude:
+                        fields.pop(field, None)
+                    serialized_data = json.dumps(data)
+                    before += len(version.serialized_data)
+                    after += len(serialized_data)
+                    compacted += 1
+                    if not options['dry_run']:
+                        Version.objects.filter(pk=version.pk).update(serialized_data=serialized_data)
+
+        print("%s %d of %d CVR versions, from %d to %d bytes, in %.1f seconds" % (
+            "Would compact" if options['dry_run'] else "Compacted", compacted, count, before, after, time.time() - start))
@@ -0,0 +1,175 @@
+"""
+Ballot manifests: how many ballots are in each batch (box) of paper ballots,
+and where a given ballot can be found.
+
+A manifest is keyed by (tabulator, batch), since batch ids are only unique
+within a tabulator.  It is built incrementally while parsing CVRs, in the same
+pass, by calling add() once per ballot in file order.  Ballot numbers are the
+1-based sequence numbers used in the "ballot" column of lookup files, and are
+located via binary search over cumulative offsets, so lookups take O(log B)
+for B batches.
+
+>>> m = BallotManifest()
+>>> for key in [(1, 1), (1, 1), (1, 2), (2, 1), (2, 1), (2, 1)]:
+...     m.add(*key)
+>>> len(m)
+6
+>>> m.locate(1)
+(1, 1, 1)
+>>> m.locate(3)
+(1, 2, 1)
+>>> m.locate(6)
+(2, 1, 3)
+>>> m.batches()
+[(1, 1, 2, 2), (1, 2, 1, 3), (2, 1, 3, 6)]
+>>> m.from_end(2, 1, 3)
+(1, 'bottom')
+
+A manifest written by write() can be read back, e.g. to check the counts of
+ballots in each box against those found in the CVRs.
+"""
+
+import csv
+import bisect
+import logging
+
+MANIFEST_HEADER = ['Tabulator', 'Batch', 'Ballots', 'Cumulative']
+
+
+def from_end(position, count):
+    """Return (n, 'top') or (n, 'bottom') to count to the given position in a batch
+    of count ballots from whichever end is closer.
+
+    >>> from_end(2, 10)
+    (2, 'top')
+    >>> from_end(8, 10)
+    (3, 'bottom')
+    """
+
+    if position <= (count + 1) // 2:
+        return (position, 'top')
+    return (count - position + 1, 'bottom')
+
+
+def batch_label(tabulator, batch):
+    """Return the label used for a batch in lookup files and reports
+
+    >>> batch_label(2, 15)
+    '2-15'
+    """
+
+    return "%s-%s" % (tabulator, batch)
+
+
+class BallotManifest(object):
+    """Count of ballots per (tabulator, batch), with cumulative offsets.
+
+    Ballots from one batch are normally contiguous in an export.  If a batch
+    turns up again later in the file, it is recorded as a separate run, so that
+    ballot numbers still map to the right batch and position within it.
+
+    >>> m = BallotManifest()
+    >>> for key in [('AB', 1), ('AB', 2), ('AB', 1)]:
+    ...     m.add(*key)
+    >>> m.locate(3)
+    ('AB', 1, 2)
+    >>> m.counts[('AB', 1)]
+    2
+    """
+
+    def __init__(self):
+        self.counts = {}        # ballots per (tabulator, batch)
+        self._keys = []         # (tabulator, batch) for each run
+        self._starts = []       # ballot number of first ballot in each run, 1-based
+        self._positions = []    # position within batch of first ballot in each run, 1-based
+        self._last = None
+        self.total = 0
+
+    def __len__(self):
+        return self.total
+
+    def add(self, tabulator, batch, count=1):
+        "Record the next count ballots, all from the given tabulator and batch"
+
+        key = (tabulator, batch)
+        if key != self._last:
+            self._keys.append(key)
+            self._starts.append(self.total + 1)
+            self._positions.append(self.counts.get(key, 0) + 1)
+            self._last = key
+
+        self.counts[key] = self.counts.get(key, 0) + count
+        self.total += count
+
+    @classmethod
+    def read(cls, filename):
+        """Read a manifest csv file with Tabulator, Batch and Ballots columns, as written by write().
+        Tabulator and batch ids are read as strings.  Any Cumulative column is checked."""
+
+        manifest = cls()
+        with open(filename) as f:
+            for row in csv.DictReader(f, skipinitialspace=True):
+                manifest.add(row['Tabulator'], row['Batch'], int(row['Ballots']))
+                if row.get('Cumulative') and int(row['Cumulative']) != manifest.total:
+                    raise ValueError("Manifest %s: Cumulative %s for batch %s should be %d" %
+                                     (filename, row['Cumulative'], batch_label(row['Tabulator'], row['Batch']), manifest.total))
+
+        logging.info("Read manifest %s: %d ballots in %d batches" % (filename, manifest.total, len(manifest.counts)))
+        return manifest
+
+    def locate(self, ballot):
+        "Return (tabulator, batch, position within batch) for the given 1-based ballot number"
+
+        if not 1 <= ballot <= self.total:
+            raise IndexError("ballot %d not in manifest of %d ballots" % (ballot, self.total))
+
+        run = bisect.bisect_right(self._starts, ballot) - 1
+        tabulator, batch = self._keys[run]
+        return (tabulator, batch, self._positions[run] + ballot - self._starts[run])
+
+    def from_end(self, tabulator, batch, position):
+        "Return (n, 'top') or (n, 'bottom') to count to the given position in the given batch"
+
+        count = self.counts[(tabulator, batch)]
+        if not 1 <= position <= count:
+            raise IndexError("position %d not in batch %s of %d ballots" % (position, batch_label(tabulator, batch), count))
+        return from_end(position, count)
+
+    def differences(self, other):
+        "Return a sorted list of (tabulator, batch, count here, count in other) for batches whose counts differ"
+
+        return sorted((key[0], key[1], self.counts.get(key, 0), other.counts.get(key, 0))
+                      for key in set(self.counts) | set(other.counts)
+                      if self.counts.get(key, 0) != other.counts.get(key, 0))
+
+    def batches(self):
+        "Return a list of (tabulator, batch, ballots, cumulative ballots) in order of first appearance"
+
+        result = []
+        seen = set()
+        cumulative = 0
+        for key in self._keys:
+            if key in seen:
+                continue
+            seen.add(key)
+            cumulative += self.counts[key]
+            result.append((key[0], key[1], self.counts[key], cumulative))
+
+        return result
+
+    def write(self, filename):
+        "Write the manifest to a csv file"
+
+        batches = self.batches()
+
+        with open(filename, 'w') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow(MANIFEST_HEADER)
+            writer.writerows(batches)
+
+        if len(batches) != len(self._keys):
+            logging.warning("Manifest %s: %d batches split into %d runs, not contiguous in the export" % (filename, len(batches), len(self._keys)))
+
+if __name__ == '__main__':
+     import doctest
+     doctest.testmod()
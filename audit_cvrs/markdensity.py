@@ -0,0 +1,144 @@
+"""
+Record the MarkDensity of each mark in Dominion CVRs, and summarize its variance
+by ballot and by batch, to help identify ballots with unusual or ambiguous marks.
+
+Everything is computed incrementally in the same pass as the parsing, with
+constant memory per batch.  Per-mark data goes to a side file via the buffered
+writers, e.g. in Parquet format for compact columnar storage.
+
+>>> density = MarkDensityRecorder()
+>>> contests = [{'Id': 1001, 'Marks': [{'CandidateId': 1, 'IsVote': True, 'IsAmbiguous': False, 'MarkDensity': 80, 'Rank': 1}]},
+...             {'Id': 1002, 'Marks': [{'CandidateId': 2, 'IsVote': False, 'IsAmbiguous': True, 'MarkDensity': 6, 'Rank': 1},
+...                                    {'CandidateId': 3, 'IsVote': True, 'IsAmbiguous': False, 'MarkDensity': 92, 'Rank': 1}]}]
+>>> density.add_ballot(2, 1, 1, contests)
+>>> density.add_ballot(2, 1, 2, contests[:1])
+>>> tabulator, batch, ballots, marks, mean, variance, mean_ballot_variance, max_ballot_variance, record = density.summary()[0]
+>>> (ballots, marks, mean, variance, round(max_ballot_variance, 2), record)
+(2, 4, 64.5, 1164.75, 1446.22, 1)
+"""
+
+import heapq
+import logging
+import writers
+
+
+class RunningStats(object):
+    """Count, mean and population variance of a stream of values, via Welford's algorithm
+
+    >>> s = RunningStats()
+    >>> for x in [2, 4, 4, 4, 5, 5, 7, 9]:
+    ...     s.add(x)
+    >>> (s.n, s.mean, s.variance)
+    (8, 5.0, 4.0)
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / float(self.n)
+        self.m2 += delta * (x - self.mean)
+
+    @property
+    def variance(self):
+        if self.n == 0:
+            return 0.0
+        return self.m2 / self.n
+
+
+class BatchDensity(object):
+    "MarkDensity statistics for the marks in one batch, and for the per-ballot variances within it"
+
+    def __init__(self):
+        self.ballots = 0
+        self.marks = RunningStats()
+        self.ballot_variances = RunningStats()
+        self.max_variance = -1.0
+        self.max_variance_record = None
+
+
+class MarkDensityRecorder(object):
+    """Record each mark to an optional writer, and accumulate MarkDensity variance
+    by ballot and by (tabulator, batch), tracking the top most variable ballots overall."""
+
+    HEADER = ['TabulatorId', 'BatchId', 'RecordId', 'ContestId', 'CandidateId',
+              'IsVote', 'IsAmbiguous', 'MarkDensity', 'Rank']
+
+    SUMMARY_HEADER = ['TabulatorId', 'BatchId', 'Ballots', 'Marks', 'MeanDensity', 'DensityVariance',
+                      'MeanBallotVariance', 'MaxBallotVariance', 'MaxVarianceRecordId']
+
+    def __init__(self, writer=None, top=10):
+        self.writer = writer
+        self.top = top
+        self.batches = {}
+        self.most_variable = []     # heap of (variance, tabulator, batch, record)
+
+    def __getstate__(self):
+        "Pickle the statistics for a checkpoint, but not the writer"
+
+        state = self.__dict__.copy()
+        state['writer'] = None
+        return state
+
+    def add_ballot(self, tabulator, batch, record, contests):
+        "Record all the marks in the given contests from one ballot"
+
+        batchstats = self.batches.get((tabulator, batch))
+        if batchstats is None:
+            batchstats = self.batches[(tabulator, batch)] = BatchDensity()
+
+        ballot = RunningStats()
+        for contest in contests:
+            for mark in contest['Marks']:
+                density = mark['MarkDensity']
+                ballot.add(density)
+                batchstats.marks.add(density)
+                if self.writer:
+                    self.writer.writerow((tabulator, batch, record, contest['Id'], mark['CandidateId'],
+                                          mark['IsVote'], mark['IsAmbiguous'], density, mark['Rank']))
+
+        batchstats.ballots += 1
+        if ballot.n == 0:
+            return
+
+        variance = ballot.variance
+        batchstats.ballot_variances.add(variance)
+        if variance > batchstats.max_variance:
+            batchstats.max_variance = variance
+            batchstats.max_variance_record = record
+
+        entry = (variance, tabulator, batch, record)
+        if len(self.most_variable) < self.top:
+            heapq.heappush(self.most_variable, entry)
+        elif entry > self.most_variable[0]:
+            heapq.heapreplace(self.most_variable, entry)
+
+    def summary(self):
+        "Return a list of per-batch summary tuples, as described by SUMMARY_HEADER"
+
+        return [(tabulator, batch, b.ballots, b.marks.n, b.marks.mean, b.marks.variance,
+                 b.ballot_variances.mean, b.max_variance, b.max_variance_record)
+                for (tabulator, batch), b in sorted(self.batches.items())]
+
+    def close(self, summary_filename=None):
+        "Finish the side file, write the summary if requested, and log the most variable ballots"
+
+        if self.writer:
+            self.writer.close()
+
+        if summary_filename:
+            summary_writer = writers.open_writer(summary_filename, self.SUMMARY_HEADER, 'csv')
+            for row in self.summary():
+                summary_writer.writerow(row)
+            summary_writer.close()
+
+        for variance, tabulator, batch, record in sorted(self.most_variable, reverse=True):
+            logging.warning("MarkDensity variance %.1f for tabulator %s batch %s record %s" % (variance, tabulator, batch, record))
+
+if __name__ == '__main__':
+     import doctest
+     doctest.testmod()
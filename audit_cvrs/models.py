@@ -4,13 +4,24 @@
 
 import sys
 import math
+import uuid
 import logging
 import StringIO
 import operator
+import datetime
 import itertools
+import threading
 from django.db import models
+from django.db.models import Q
 from django.db import transaction
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
+from django.dispatch import receiver
 from django.core.cache import cache
+from django.utils import timezone
+from reversion import revisions as reversion
+from audit_cvrs import cvr
+from audit_cvrs import events
+from audit_cvrs import util
 # import electionaudits.erandom as erandom
 
 class CountyElection(models.Model):
@@ -43,10 +54,10 @@ class CVR(models.Model):
         )
 
     election = models.ForeignKey(CountyElection)
-    name = models.CharField(max_length=80)
+    name = models.CharField(max_length=80, db_index=True)
     cvr_text = models.TextField()
-    status = models.CharField(choices=STATUS_CHOICES, default="Not seen", max_length=20)
-    discrepancy = models.IntegerField(choices=DISCREPANCY_CHOICES, null=True, blank=True)
+    status = models.CharField(choices=STATUS_CHOICES, default="Not seen", max_length=20, db_index=True)
+    discrepancy = models.IntegerField(choices=DISCREPANCY_CHOICES, null=True, blank=True, db_index=True)
     notes = models.TextField(default="", blank=True)
 
     def __unicode__(self):
@@ -54,3 +65,273 @@ class CVR(models.Model):
 
     class Meta:
         unique_together = ("election", "name")
+
+class CVRVersionAdapter(reversion.VersionAdapter):
+    """Version only the fields which change during the audit.  cvr_text is fixed when the CVRs
+    are imported, so a copy of it in every version would just bloat the reversion tables."""
+
+    exclude = ("cvr_text",)
+
+reversion.register(CVR, adapter_cls=CVRVersionAdapter)
+
+def stored_cvr_text(name):
+    """Return the text of the CVR with the given name, looked up in the CVR file again by its ballot
+    number as when it was imported, or None if it can't be, e.g. if its name isn't from a lookup file"""
+
+    ballot = util.name_to_ballot(name)
+    if ballot is None or cvr.CVR_PATH is None:
+        return None
+    try:
+        return cvr.lookup_cvr(ballot)
+    except (KeyError, IOError, OSError) as e:
+        logging.warning("Can't look up the text of CVR %s: %s" % (name, e))
+        return None
+
+@receiver(pre_save, sender=CVR)
+def restore_cvr_text(sender, instance, raw=False, **kwargs):
+    """Versions don't include the cvr_text, so when one is reverted (saved raw),
+    keep the cvr_text that is already in the database.  If the CVR was deleted, and is being
+    recovered, read its text from the CVR file again.  See CVRAdmin.recover_view."""
+
+    if raw and not instance.cvr_text and instance.pk is not None:
+        instance.cvr_text = CVR.objects.filter(pk=instance.pk).values_list('cvr_text', flat=True).first()
+        if instance.cvr_text is None:
+            instance.cvr_text = stored_cvr_text(instance.name) or ""
+
+PROGRESS_CACHE_SECONDS = 300
+
+def progress_key(election_id, changes):
+    return "audit_progress:%d:%d" % (election_id, changes)
+
+class AuditCounter(models.Model):
+    """Denormalized counts of the CVRs in an election by status and by discrepancy, so that the
+    progress of the audit can be shown without scanning the CVR table.  They are kept up to date
+    by the CVR signal receivers below, and rebuilt after a bulk import, which bypasses them.
+    The "total" counter also marks that the counts for the election have been built, and the
+    "changes" counter goes up with every change to them, e.g. to make ETags for selection state."""
+
+    FIELDS = ('status', 'discrepancy')
+
+    election = models.ForeignKey(CountyElection)
+    field = models.CharField(max_length=20)
+    value = models.CharField(max_length=20, blank=True)
+    count = models.IntegerField(default=0)
+
+    def __unicode__(self):
+        return "%s %s: %d" % (self.field, self.value, self.count)
+
+    class Meta:
+        unique_together = ("election", "field", "value")
+
+    @classmethod
+    def rebuild(cls, election_id):
+        "Replace the counters for the given election by counting its CVRs"
+
+        with transaction.atomic():
+            changes = cls.objects.filter(election_id=election_id, field='changes').values_list('count', flat=True).first() or 0
+            cls.objects.filter(election_id=election_id).delete()
+            cvrs = CVR.objects.filter(election_id=election_id).order_by()
+            counters = [cls(election_id=election_id, field='total', value='', count=cvrs.count()),
+                        cls(election_id=election_id, field='changes', value='', count=changes + 1)]
+            for field in cls.FIELDS:
+                for value, count in cvrs.values_list(field).annotate(models.Count('id')):
+                    counters.append(cls(election_id=election_id, field=field, value="%s" % value, count=count))
+            cls.objects.bulk_create(counters)
+
+    @classmethod
+    def adjust(cls, election_id, changes):
+        """Atomically add each delta in the given list of (field, value, delta) to the counters
+        for the given election, or rebuild them if they haven't been built yet"""
+
+        with transaction.atomic():
+            if not cls.objects.filter(election_id=election_id, field='total').exists():
+                cls.rebuild(election_id)
+                return
+
+            for field, value, delta in changes + [('changes', '', 1)]:
+                counters = cls.objects.filter(election_id=election_id, field=field, value="%s" % value)
+                if not counters.update(count=models.F('count') + delta):
+                    counter, created = cls.objects.get_or_create(election_id=election_id, field=field, value="%s" % value)
+                    counters.update(count=models.F('count') + delta)
+
+    @classmethod
+    def changes(cls, election_id):
+        "Return the number of changes to the counters for the given election, straight from the database"
+
+        changes = cls.objects.filter(election_id=election_id, field='changes').values_list('count', flat=True).first()
+        if changes is None:
+            cls.rebuild(election_id)
+            return cls.changes(election_id)
+        return changes
+
+    @classmethod
+    def progress(cls, election_id):
+        """Return a dictionary of the number of CVRs in the given election, under 'total', and
+        dictionaries of the numbers by 'status' and by 'discrepancy', keyed by value as a string.
+        The result is cached under the count of changes, read from the database each time,
+        so changes made by other processes, e.g. manage.py parse, are seen right away."""
+
+        key = progress_key(election_id, cls.changes(election_id))
+        progress = cache.get(key)
+        if progress is not None:
+            return progress
+
+        progress = {'total': 0, 'changes': 0, 'status': {}, 'discrepancy': {}}
+        for field, value, count in cls.objects.filter(election_id=election_id).values_list('field', 'value', 'count'):
+            if field not in cls.FIELDS:
+                progress[field] = count
+            elif count:
+                progress[field][value] = count
+
+        cache.set(key, progress, PROGRESS_CACHE_SECONDS)
+        return progress
+
+@receiver(pre_save, sender=CVR)
+def note_counted_values(sender, instance, **kwargs):
+    "Remember the status and discrepancy which the CVR had before it is saved, for count_cvr"
+
+    instance._counted = None
+    if instance.pk is not None:
+        instance._counted = CVR.objects.filter(pk=instance.pk).values_list('status', 'discrepancy').first()
+
+@receiver(post_save, sender=CVR)
+def count_cvr(sender, instance, **kwargs):
+    "Update the counters for the CVR's election if its status or discrepancy changed"
+
+    old = getattr(instance, '_counted', None)
+    new = (instance.status, instance.discrepancy)
+    if old == new:
+        return
+
+    changes = [('total', '', 1)] if old is None else []
+    for i, field in enumerate(AuditCounter.FIELDS):
+        if old is None or old[i] != new[i]:
+            changes.append((field, new[i], 1))
+            if old is not None:
+                changes.append((field, old[i], -1))
+
+    AuditCounter.adjust(instance.election_id, changes)
+    publish_cvr(instance)
+
+# Ids of the elections being deleted in this thread, whose CVRs needn't be uncounted
+DELETING = threading.local()
+
+@receiver(pre_delete, sender=CountyElection)
+def note_deleting_election(sender, instance, **kwargs):
+    "Note that the election is being deleted, along with its CVRs and counters"
+
+    if not hasattr(DELETING, 'elections'):
+        DELETING.elections = set()
+    DELETING.elections.add(instance.pk)
+
+@receiver(post_delete, sender=CountyElection)
+def deleted_election(sender, instance, **kwargs):
+    DELETING.elections.discard(instance.pk)
+
+@receiver(post_delete, sender=CVR)
+def uncount_cvr(sender, instance, **kwargs):
+    """Remove a deleted CVR from the counters for its election, unless the whole election is being
+    deleted, when the counters go too, and adjusting them could leave orphans behind"""
+
+    if instance.election_id in getattr(DELETING, 'elections', ()):
+        return
+
+    AuditCounter.adjust(instance.election_id,
+                        [('total', '', -1), ('status', instance.status, -1), ('discrepancy', instance.discrepancy, -1)])
+    publish_cvr(instance, deleted=True)
+
+def publish_cvr(cvr, deleted=False):
+    "Publish the new status and discrepancy of the CVR to the event hub, once they are committed"
+
+    data = dict(id=cvr.id, election=cvr.election_id, name=cvr.name, status=cvr.status,
+                discrepancy=cvr.discrepancy, discrepancy_display=cvr.get_discrepancy_display() or "")
+    if deleted:
+        data['deleted'] = True
+    transaction.on_commit(lambda: events.HUB.publish('cvr', data))
+
+def change_status(election_id, cvrs, old, new):
+    """Change the status of the CVRs in the given queryset from old to new in a single update,
+    if they still have the old status, and update the counters and publish the changes as the
+    signal receivers would.  Return the number changed."""
+
+    changed = cvrs.filter(status=old).update(status=new)
+    if changed:
+        AuditCounter.adjust(election_id, [('status', old, -changed), ('status', new, changed)])
+        for cvr in cvrs.only('id', 'election', 'name', 'status', 'discrepancy'):
+            publish_cvr(cvr)
+    return changed
+
+ASSIGNMENT_SECONDS = 30 * 60
+
+class Assignment(models.Model):
+    """The work queue of CVRs to audit: the team each CVR is assigned to, if any, and until when.
+    It also has the box (batch label) and position of each CVR, so they can be handed out in order
+    of where the ballots are.  Each claim is a single conditional UPDATE, which marks the rows it
+    changes with a new token, so two teams can never be given the same CVR."""
+
+    cvr = models.OneToOneField(CVR, primary_key=True)
+    election = models.ForeignKey(CountyElection)
+    box = models.CharField(max_length=80)
+    position = models.IntegerField(default=0)
+    team = models.CharField(max_length=80, blank=True)
+    token = models.CharField(max_length=32, blank=True, db_index=True)
+    claimed = models.DateTimeField(null=True, blank=True)
+    expires = models.DateTimeField(null=True, blank=True)
+
+    def __unicode__(self):
+        return "%s: %s until %s" % (self.cvr_id, self.team, self.expires)
+
+    class Meta:
+        index_together = [("election", "box", "position"), ("election", "expires")]
+
+    @classmethod
+    def populate(cls, election_id):
+        "Add the CVRs of the given election which aren't in the queue yet, and return how many were added"
+
+        missing = CVR.objects.filter(election_id=election_id, assignment__isnull=True).values_list('id', 'name')
+        assignments = [cls(cvr_id=id, election_id=election_id, box=box, position=position)
+                       for id, name in missing for box, position in [util.name_to_box(name)]]
+        cls.objects.bulk_create(assignments, batch_size=100)
+        return len(assignments)
+
+    @classmethod
+    def release_expired(cls, election_id, now):
+        "Return CVRs which are still Assigned after their assignments expire to the queue, as Selected"
+
+        token = uuid.uuid4().hex
+        if (cls.objects.filter(election_id=election_id, expires__lt=now, cvr__status='Assigned')
+                .exclude(team='').update(team='', token=token, expires=None)):
+            change_status(election_id, CVR.objects.filter(id__in=cls.objects.filter(token=token).values('cvr')), 'Assigned', 'Selected')
+
+    @classmethod
+    def claim(cls, election_id, team, count, seconds=ASSIGNMENT_SECONDS):
+        """Assign up to count of the Selected CVRs in the given election which aren't assigned
+        to a team, to the given team for the given number of seconds, in order of box and position.
+        Their status becomes Assigned.  Return a list of their Assignments.
+
+        Claims in this process take turns via CLAIM_LOCK, rather than all contending for the SQLite
+        write lock, where some can wait so long that they fail as "database is locked".
+        The conditional update still keeps claims from other processes from overlapping."""
+
+        for attempt in range(2):
+            now = timezone.now()
+            token = uuid.uuid4().hex
+            with CLAIM_LOCK, transaction.atomic():
+                cls.release_expired(election_id, now)
+
+                unassigned = Q(expires__isnull=True) | Q(expires__lt=now)
+                waiting = (cls.objects.filter(unassigned, election_id=election_id, cvr__status='Selected')
+                           .order_by('box', 'position', 'cvr').values('cvr')[:count])
+                if cls.objects.filter(unassigned, cvr__in=waiting).update(
+                        team=team, token=token, claimed=now, expires=now + datetime.timedelta(seconds=seconds)):
+                    change_status(election_id, CVR.objects.filter(id__in=cls.objects.filter(token=token).values('cvr')), 'Selected', 'Assigned')
+                    return list(cls.objects.filter(token=token).select_related('cvr').defer('cvr__cvr_text', 'cvr__notes')
+                                .order_by('box', 'position', 'cvr'))
+
+            # CVRs imported or added since the queue was last filled aren't in it yet
+            if not cls.populate(election_id):
+                break
+
+        return []
+
+CLAIM_LOCK = threading.Lock()
@@ -5,27 +5,39 @@ and produce a cvr.csv file.
 
 Read the CandidateManifest.json file to map ids to candidate names.
 Read the CvrExport.json file for the CVR data.
-Print out a cvr.csv file
+Print out a cvr.csv file, or write it in the given format
 
-Usage:
+%InsertOptionParserUsage%
+
+Examples:
 
 cd dominion-cvr-directory
 parse_dominion_cvrs.py zip-file > cvr.csv
+parse_dominion_cvrs.py -o cvr.parquet zip-file
+
+also produces test.lookup file, a ballot_manifest.csv file with the number
+of ballots in each (tabulator, batch), and summaries in debugging output.
+With --density, MarkDensity data for each mark goes to a separate file,
+and the ballots with the most variable MarkDensity are logged.
+
+With --checkpoint, progress is saved after each completed CvrExport file in
+the zip file (at most once per --checkpoint_interval seconds), and a parse
+restarted with the same arguments resumes from there, producing the same output.
 
-also produces test.lookup file, and summaries in debugging output
+The export is validated in the same pass: records of the wrong shape, e.g. with more
+contests or marked candidates than the manifests have, unknown contest and candidate
+ids, multiple IsVote marks in a contest, IsCurrent flags inconsistent with Modified
+records, and duplicate (tabulator, batch, record) keys are counted, and summarized
+with a few samples at the end, or written to --validation_report.
 
 Todo:
 
 Cleanup:
   Produce clean cvr.csv file, moving later material to other files
-  Augment batch id for stats to make it unique: include tabulator id
   Reduce volume of debug data
-  Rip out unused "votes" variable
 
-Optionally record MarkDensity information (modifying current debugging code)
 Optionally record data on Modified (adjudicated) ballots
  perhaps integrate with NOVOTE output
-Summarize MarkDensity variance by ballot, identify interesting ones
 
 Parse ElectionId and use it to name CountyElection in electionAudits
 
@@ -41,12 +53,46 @@ import csv
 import collections
 import logging
 import zipfile
+from optparse import OptionParser
 import sampler
+import manifest
+import writers
+import markdensity
+import validation
+from checkpoint import Checkpoint, file_identity
+
+parser = OptionParser(prog="parse_dominion_cvrs.py", usage="Usage: %prog [options] zip-file")
+
+parser.add_option("-o", "--output",
+  help="write the cvr table to this file rather than stdout" )
+
+parser.add_option("-f", "--format",
+  type="choice", choices=writers.FORMATS,
+  help="output format: %s.  Default is based on the output file name, else csv" % ", ".join(writers.FORMATS))
+
+parser.add_option("--density",
+  help="record IsVote, IsAmbiguous, MarkDensity and Rank of every mark to this file, e.g. marks.parquet" )
+
+parser.add_option("--density_summary",
+  help="write a csv summary of MarkDensity variance by batch to this file" )
+
+parser.add_option("--validation_report",
+  help="write counts and samples of anomalies found in the export to this json file" )
+
+parser.add_option("--checkpoint",
+  help="save progress to this file, and resume from it if it exists.  Needs plain csv output files" )
+
+parser.add_option("--checkpoint_interval",
+  type="float", default=60.0,
+  help="minimum number of seconds between checkpoints, default 60" )
+
+# incorporate OptionParser usage documentation in our docstring
+__doc__ = __doc__.replace("%InsertOptionParserUsage%\n", parser.format_help())
 
 def select_ballots(seed, n, N):
-    "Randomly select n of N ballots using Rivest's sampler library"
+    "Randomly select n of N ballots, numbered from 1 as in the ballot manifest, using Rivest's sampler library"
 
-    old_output_list, new_output_list = sampler.generate_outputs(n, True, 0, N, seed, False)
+    old_output_list, new_output_list = sampler.generate_outputs(n, True, 1, N, seed, False)
 
     new_output_list = sorted(new_output_list)
 
@@ -54,11 +100,11 @@ def select_ballots(seed, n, N):
 
     return (new_output_list)
 
-def parse():
+def parse(options, zipfilename):
 
     logging.basicConfig(level=logging.DEBUG)
 
-    zipf = zipfile.ZipFile(sys.argv[1])
+    zipf = zipfile.ZipFile(zipfilename)
 
     with zipf.open("ContestManifest.json") as jsonFile:
         rawJson = jsonFile.read()
@@ -91,50 +137,74 @@ def parse():
     candidates = collections.OrderedDict(sorted(unordered_candidates.items()))
     numCandidates = len(candidates)
 
-    headers = "TabulatorId,BatchId,RecordId,CountingGroupId,IsCurrent,BallotTypeId,PrecinctPortionId,"
-
-    numColumns = numCandidates + headers.count(",")
+    headers = ["TabulatorId", "BatchId", "RecordId", "CountingGroupId", "IsCurrent", "BallotTypeId", "PrecinctPortionId"]
 
     # Produce a candidateIndex to map candidate Ids from json to sequential numbers starting at 0, as they should appear in the CSV
     candidateIndex = {}
     i = 0
     for id, name in candidates.iteritems():
-        headers += '"%s",' % name
+        headers.append(name)
         candidateIndex[id] = i
         i += 1
 
-    headers = headers.strip(",")
-
     logging.info("Found %d candidates:\n %s" % (numCandidates, candidates))
     logging.info("Candidate Index by contest: %s" % candidateIndex)
 
     logging.info("First manifest item: %s" % candidateManifest['List'][1])
 
-    print(headers)
-
     seed = "1234"
-    N = 1344
-    n = 16
-
-    selected = select_ballots(seed, n, N)
-
-    sample_lookup_name = "test.lookup"
-    sample_lookup = open(sample_lookup_name, "w")
-
-    sample_lookup.write('sorted_number,ballot, batch_label, which_ballot_in_batch\n')
+    sample_size = 16
 
     n = 0
-    sample_index = 0
+    ballot_manifest = manifest.BallotManifest()
     totals = [0] * numCandidates
     contestBallots = collections.Counter()
-    contestBallotsByBatchManager = {}    # Counters for each contest giving number of ballots by batch
-
-    logging.debug("Density:TabulatorId,BatchId,RecordId,CountingGroupId,IsAmbiguous,MarkDensity,Rank,PartyId")
+    contestBallotsByBatchManager = {}    # Counters for each contest giving number of ballots by tabulator and batch
+
+    novotes = 0        # Marks which aren't counted as votes, e.g. ambiguous marks
+    completed = set()  # CvrExport files in the zip file which have been fully processed
+    validator = validation.Validator(all_contests, candidateIndex,
+                                     collections.Counter(candidate['ContestId'] for candidate in candidateManifest['List']))
+
+    density = None
+    density_writer = None
+    if options.density or options.density_summary:
+        density = markdensity.MarkDensityRecorder()
+
+    # Resume from the checkpoint, if there is one, truncating output files to the checkpointed offsets
+    state = None
+    checkpoint = None
+    if options.checkpoint:
+        checkpoint = Checkpoint(options.checkpoint, options.checkpoint_interval,
+                                (file_identity(zipfilename), options.output, options.density))
+        state = checkpoint.load()
+
+    if state:
+        n = state['n']
+        ballot_manifest = state['ballot_manifest']
+        totals = state['totals']
+        contestBallots = state['contestBallots']
+        contestBallotsByBatchManager = state['contestBallotsByBatchManager']
+        novotes = state['novotes']
+        completed = state['completed']
+        density = state['density']
+        validator = state['validator']
+        logging.warning("Resuming after %d ballots from %d completed files" % (n, len(completed)))
+
+    cvr_writer = writers.open_writer(options.output, headers, options.format, offset=state and state['output_offset'])
+
+    if options.density:
+        density_writer = writers.open_writer(options.density, markdensity.MarkDensityRecorder.HEADER, offset=state and state['density_offset'])
+        density.writer = density_writer
 
     # with open("CvrExport.json") as jsonFile:
     for zipinfo in zipf.infolist():
         logging.info("Encountering exported file %s" % zipinfo.filename)
 
+        if zipinfo.filename in completed:
+            logging.info("Skipping %s, completed before checkpoint" % zipinfo.filename)
+            continue
+
         if "CvrExport" in zipinfo.filename:
             rawJson = zipf.open(zipinfo.filename).read()
             #rawJson = jsonFile.read()        # FIXME: better to use ijson here and not read it all in at once
@@ -144,86 +214,104 @@ def parse():
             for session in cvrs['Sessions']:
                 n += 1
 
-                # print("Session keys: %s" % session.keys())
+                ballot_manifest.add(session['TabulatorId'], session['BatchId'])
+                batch = manifest.batch_label(session['TabulatorId'], session['BatchId'])
 
-                sessionInfo = "%s,%s,%s,%s" % (session['TabulatorId'], session['BatchId'], session['RecordId'], session['CountingGroupId'])
+                # print("Session keys: %s" % session.keys())
 
-                original = session['Original']
+                original = session.get('Original', {})
 
                 modified = session.get('Modified', None)
-                if modified:
-                    if original['IsCurrent'] != False:
-                        logging.error("Surprised to see IsCurrent != false given presence of Modified record. It has IsCurrent=%s\n%s" % (modified['IsCurrent'], original))
 
+                # Skip records which can't make a proper row.  They are counted by the validator
+                contests = validator.check_record(session, modified or original)
+                if contests is None:
+                    continue
+
+                validator.check_session(session, original, modified)
+                if modified:
                     original = modified
 
                 # print original.keys()
 
-                ballotInfo = "%s,%s,%s" % (original['IsCurrent'], original['BallotTypeId'], original['PrecinctPortionId'])
+                voteArray = [0] * numCandidates
 
-                voteArray = ["0"] * numCandidates
-                votes = ""
-                try:
-                    # e.g. in Dominion Democracy Suite version 4.21.3.0
-                    contests = original['Contests']
-                except KeyError:
-                    logging.debug("For %s, original doesn't have 'Contests' in it!\n Keys: %s\n Dump: %s" % (zipinfo.filename, original.keys(), original))
-                    # e.g. in Dominion Democracy Suite version 5.5.32.4
-                    contests = original['Cards'][0]['Contests']
+                if density:
+                    density.add_ballot(session['TabulatorId'], session['BatchId'], session['RecordId'], contests)
 
                 for contest in contests:
                     contestBallots[contest['Id']] += 1
                     contestBallotsByBatch = contestBallotsByBatchManager.get(contest['Id'], collections.Counter())
-                    contestBallotsByBatch[session['BatchId']] += 1
+                    contestBallotsByBatch[batch] += 1
                     contestBallotsByBatchManager[contest['Id']] = contestBallotsByBatch
 
-                    votes += "%s," % contest['Id']
+                    validator.check_contest(session, contest)
 
                     marks = contest['Marks']
                     if len(marks) > 1:
-                        votemarks = [mark for mark in marks if mark['IsVote']]
-                        if len(votemarks) > 1:
-                            logging.error("FIXME: More than 1 IsVote mark: I can't handle this yet. Council race? %s" % marks) # '\n'.join(list(marks)))
-                        marks = votemarks
-
-                    if len(marks) == 0:
-                        votes += "-1,"
-                    else:
-                        mark = marks[0]
-                        if mark['IsVote']:
-                            voteArray[candidateIndex[mark['CandidateId']]] = "1"
-                            votes += "%s," % mark['CandidateId']
-                        else:
-                            votes += "NOVOTE:%s," % (mark['CandidateId'])
-                            logging.error("NOVOTE for %s" % mark)
+                        # FIXME: only the first IsVote mark is recorded.  Multiple ones are counted by the validator
+                        marks = [mark for mark in marks if mark['IsVote']]
 
-                    logging.debug("Density:%s,%s,%s,%s,%s" % (sessionInfo, mark['IsAmbiguous'], mark['MarkDensity'], mark['Rank'], mark.get('PartyId')))
+                    if marks:
+                        mark = marks[0]
+                        if not mark['IsVote']:
+                            novotes += 1
+                        elif mark['CandidateId'] in candidateIndex:
+                            voteArray[candidateIndex[mark['CandidateId']]] = 1
 
                     # print("%s %d" % (contest.keys(), len(contest['Marks'])))
-                    # votes +=
-
-                row = ("%s,%s,%s" % (sessionInfo, ballotInfo, ','.join([v for v in voteArray])))
-                if row.count(",") + 1 != numColumns:
-                    logging.error("FIXME: problem in row, %d columns, not %d. %s" % (row.count(",") + 1, numColumns, row) )
-                else:
-                    print(row)
-                    totals = [totals[i] + int(voteArray[i])  for i in xrange(numCandidates)]
 
-                    if n in selected:
-                        sample_index += 1
-                        #batch = "%s_%s_%s" % (session['TabulatorId'], session['BatchId'], session['CountingGroupId'])
-                        batch = "%s" % (session['BatchId'])
-                        sample_lookup.write("%d,%d,%s,%d\n" % (sample_index, n, batch, session['RecordId']))  # FIXME: is RecordId the proper sequence number? or use sequence in file??
-
-                # row = ("%s,%s,%s" % (sessionInfo, ballotInfo, votes))
-                # remove trailing comma
-                # print(row.strip(','))
+                row = [session['TabulatorId'], session['BatchId'], session['RecordId'], session['CountingGroupId'],
+                       original['IsCurrent'], original['BallotTypeId'], original['PrecinctPortionId']] + voteArray
+                cvr_writer.writerow(row)
+                totals = [totals[i] + voteArray[i]  for i in xrange(numCandidates)]
 
                 #if not original.get(["IsCurrent"]):
                 #  print "not current: %d: %s" % (n, original["IsCurrent"])
 
-    if n != N:
-        logging.error("Ballot count mismatch: told %d, found %d" % (N, n))
+            completed.add(zipinfo.filename)
+
+            if checkpoint and checkpoint.due():
+                checkpoint.save(dict(n=n, ballot_manifest=ballot_manifest, totals=totals, contestBallots=contestBallots,
+                                     contestBallotsByBatchManager=contestBallotsByBatchManager, novotes=novotes,
+                                     completed=completed, density=density, validator=validator,
+                                     output_offset=cvr_writer.checkpoint(),
+                                     density_offset=density_writer and density_writer.checkpoint()))
+
+    cvr_writer.close()
+
+    if novotes:
+        logging.error("%d NOVOTE marks, not counted as votes.  Use --density to record details of every mark" % novotes)
+
+    if density:
+        density.close(options.density_summary)
+
+    validator.log_report()
+    if options.validation_report:
+        validator.write_report(options.validation_report)
+
+    ballot_manifest.write("ballot_manifest.csv")
+
+    # Select from the ballots actually found, now that the manifest knows how many there are
+    N = ballot_manifest.total
+    selected = []
+    if N:
+        selected = select_ballots(seed, sample_size, N)
+    else:
+        logging.error("No ballots to select from")
+
+    # Locate selected ballots via the manifest.  Position is the sequence in the export within the batch,
+    # which can differ from RecordId when ballots were rescanned or adjudicated out of order.
+    sample_lookup = writers.open_writer("test.lookup", ['sorted_number', 'ballot', ' batch_label', ' which_ballot_in_batch'], 'csv')
+
+    for sample_index, ballot in enumerate(selected):
+        tabulator, batchId, position = ballot_manifest.locate(ballot)
+        sample_lookup.writerow((sample_index + 1, ballot, manifest.batch_label(tabulator, batchId), position))
+
+    sample_lookup.close()
+
+    if checkpoint:
+        checkpoint.remove()
 
     candidateRevIndex = {v: k for k, v in candidateIndex.iteritems()}
 
@@ -233,13 +321,12 @@ def parse():
     print contestBallots.most_common(10)
 
     for contestId in sorted(contestBallots):
-        logging.warning("%d Ballots for contest %s" % (contestBallots[contestId], all_contests[contestId]))
+        logging.warning("%d Ballots for contest %s" % (contestBallots[contestId], all_contests.get(contestId, contestId)))
 
     import pandas as pd
     df = pd.DataFrame.from_dict(contestBallotsByBatchManager, orient='index').transpose()
 
     # Print description statistics for each contest of number of ballots by batch
-    # FIXME: assumes a single tabulator. need to combine tabulator and batch ids....
 
     # hmmm - how to add the contest name (Description) to the mix? df['Contest'] = apply(
     # Use option_context to print all rows and columns out, no maximums
@@ -248,13 +335,26 @@ def parse():
 
     print("Contest\tBatch\tBallots")
     for contest in sorted(contestBallotsByBatchManager.keys()):
-        for batchId in contestBallotsByBatchManager[contest].keys():
+        for batchId in sorted(contestBallotsByBatchManager[contest]):
             print("%s\t%s\t%d" % (contest, batchId, contestBallotsByBatchManager[contest][batchId]))
 
     print "Done"
 
-def main():
-    parse()
+def main(parser):
+    "Run parse_dominion_cvrs with given OptionParser arguments"
+
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1:
+        parser.error("Specify a single zip file of Dominion CVR exports")
+
+    if options.checkpoint:
+        if not options.output or writers.format_for(options.output) != 'csv' or options.format not in (None, 'csv'):
+            parser.error("--checkpoint needs a plain csv --output file")
+        if options.density and writers.format_for(options.density) != 'csv':
+            parser.error("--checkpoint needs a plain csv --density file")
+
+    parse(options, args[0])
 
 if __name__ == "__main__":
-    main()
+    main(parser)
@@ -10,6 +10,9 @@ import optparse
 from optparse import make_option
 import logging
 import csv
+import time
+import itertools
+import multiprocessing
 from datetime import datetime
 from audit_cvrs import cvr
 
@@ -18,7 +21,8 @@ import audit_cvrs.util
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "fooproject.settings")
 from django.conf import settings
 
-from django.db import transaction
+from django.db import connection, transaction
+from django.utils.encoding import force_text
 import audit_cvrs.models as models
 
 __author__ = "Neal McBurnett <http://neal.mcburnett.org/>"
@@ -38,6 +42,12 @@ option_list = (
     make_option("-e", "--election_name", default="Audit_Cvrs Test Election",
                   help="the name for this ELECTION"),
 
+    make_option("--batch_size", type="int", default=500,
+                  help="number of CVRs to look up and insert at a time, default 500, at most 998 with SQLite"),
+
+    make_option("-j", "--jobs", type="int", default=1,
+                  help="number of worker processes to parse files and look up CVRs, default 1"),
+
     make_option("-d", "--debug",
                   action="store_true", default=False,
                   help="turn on debugging output"),
@@ -92,56 +102,68 @@ def parse(args, options):
 
     logging.debug("files = %s" % list(files))
 
-    totals = {}
-
-    logging.info("%s Start processing files" % (datetime.now().strftime("%H:%M:%S")))
-
+    lookups = []
     for file in files:
-        logging.info("%s Processing %s" % (datetime.now().strftime("%H:%M:%S"), file))
         if file.endswith(".lookup"):
-            parse_lookup(file, options)
+            lookups.append(file)
         else:
             logging.warning("Ignoring %s - unknown extension" % file)
-            continue
 
-    logging.info("%s Exit" % (datetime.now().strftime("%H:%M:%S")))
+    logging.info("%s Start processing files" % (datetime.now().strftime("%H:%M:%S")))
 
-"""
-FIXME
-when I put this decorator on
-@transaction.commit_on_success
-I get this:
-
-    "Your database backend doesn't behave properly when "
-django.db.transaction.TransactionManagementError: Your database backend doesn't behave properly when autocommit is off. Turn it on before using 'atomic'.
-
-Based on this
- Django 1.6 TransactionManagementError: database doesn't behave properly when autocommit is off - Stack Overflow
-  http://stackoverflow.com/questions/20039250/django-1-6-transactionmanagementerror-database-doesnt-behave-properly-when-aut
-seems to be an sqlite3 issue and I switched to @transaction.atomic().  Still big speedup over nothing:
-  atomic:  real  0m1.027s user 0m0.676s sys 0m0.116s
-  nothing: real 0m34.958s user 0m0.936s sys 0m0.332s
-"""
-@transaction.atomic()
-def parse_lookup(file, options):
-    """Parse a lookup file: a csv file of selections from Stark's auditTools.
-    For each selection, look up the full Cast Vote Record via cvr.py
+    # Parse files and look up CVRs in a pool of workers, which don't touch the database,
+    # while this process is the single writer, importing each file in one transaction.
+    pool = None
+    if options.jobs > 1 and len(lookups) > 1:
+        pool = multiprocessing.Pool(options.jobs)
+        results = pool.imap_unordered(timed_read_lookup, lookups)
+    else:
+        results = itertools.imap(timed_read_lookup, lookups)
+
+    election, created = models.CountyElection.objects.get_or_create(name=options.election_name)
+
+    timings = []
+    for file, rows, read_seconds, cache_counts in results:
+        logging.info("%s Importing %s" % (datetime.now().strftime("%H:%M:%S"), file))
+        start = time.time()
+        with transaction.atomic():
+            counts = import_cvrs(election, rows, options.batch_size)
+        timings.append((file, len(rows), read_seconds, time.time() - start, counts, cache_counts))
+
+    if pool:
+        pool.close()
+        pool.join()
+
+    print "%-40s %8s %8s %8s %8s %8s %8s %8s %10s %10s" % ("File", "Rows", "Read s", "Write s", "Rows/s",
+                                                           "Created", "Updated", "Same", "Cache hits", "misses")
+    for file, rows, read_seconds, write_seconds, counts, (hits, misses) in sorted(timings):
+        print "%-40s %8d %8.2f %8.2f %8.0f %8d %8d %8d %10d %10d" % (file, rows, read_seconds, write_seconds,
+                                                                     rows / max(read_seconds + write_seconds, 1e-6),
+                                                                     counts['created'], counts['updated'], counts['unchanged'],
+                                                                     hits, misses)
 
-    Sample data;
+    logging.info("%s Exit" % (datetime.now().strftime("%H:%M:%S")))
 
-sorted_number,ballot, batch_label, which_ballot_in_batch
-1, 288, s1b1, 288
-2, 324, s1b1, 324
-    """
+def timed_read_lookup(file):
+    """Return the file name, the result of read_lookup, the seconds it took, and the hits and misses
+    in the CVR cache of this process while it ran, for parse() workers"""
+
+    start = time.time()
+    hits, misses = cvr.CACHE.hits, cvr.CACHE.misses
+    rows = read_lookup(file)
+    return file, rows, time.time() - start, (cvr.CACHE.hits - hits, cvr.CACHE.misses - misses)
 
-    election_name = options.election_name
-    election, created = models.CountyElection.objects.get_or_create(name=election_name)
+def read_lookup(file):
+    """Return a list of (ballot name, CVR text) for the selections in the given lookup file,
+    looking up each CVR via cvr.py"""
 
     cvr.init()
 
-    reader = csv.DictReader(open(file), skipinitialspace=True)
+    selections = list(csv.DictReader(open(file), skipinitialspace=True))
+    cvr.warm_cache([r['ballot'] for r in selections])
 
-    for r in reader:
+    rows = []
+    for r in selections:
         batch_label = r['batch_label']
         sequence = r['which_ballot_in_batch']
 
@@ -162,13 +184,74 @@ sorted_number,ballot, batch_label, which_ballot_in_batch
 
         """
 
-        print r
+        logging.debug("Parse selection: %s" % r)
         cvr_text = cvr.lookup_cvr(r['ballot'])
         logging.debug("Parse: selected CVR: \n%s" % cvr_text)
 
         ballot_name = "%s_%s_%s_%s" % (r['sorted_number'], r['ballot'], r['batch_label'], r['which_ballot_in_batch'])
+        rows.append((ballot_name, cvr_text))
+
+    return rows
+
+# The most variables SQLite allows in a query, by default
+SQLITE_MAX_VARIABLES = 999
+
+def import_cvrs(election, rows, batch_size=500):
+    """Insert or update CVRs for the given election from a list of (name, cvr_text), batch_size at a time.
+
+    CVRs are keyed by (election, name), as in CVR.Meta.unique_together.  New ones are inserted
+    with a single executemany per batch, which is much faster than bulk_create for large samples,
+    and existing ones only have their cvr_text updated if it has changed, leaving the status,
+    discrepancy and notes from the audit alone.  So it is safe to re-run.
+    Return a dictionary of counts of CVRs created, updated and unchanged.
+    Names and text may be utf-8 byte strings, as read_lookup returns, or unicode.
+
+    On SQLite, batch_size is capped so the lookup of existing CVRs stays within its limit on query variables.
+    """
 
-        models.CVR.objects.create(election=election, name=ballot_name, cvr_text=cvr_text, status="Selected")
+    if batch_size < 1:
+        raise ValueError("batch_size must be at least 1, not %d" % batch_size)
+    if connection.vendor == 'sqlite':
+        # One variable for the election, and one for each name
+        batch_size = min(batch_size, SQLITE_MAX_VARIABLES - 1)
+
+    counts = dict(created=0, updated=0, unchanged=0)
+
+    qn = connection.ops.quote_name
+    columns = ['election_id', 'name', 'cvr_text', 'status', 'notes']
+    insert = "INSERT INTO %s (%s) VALUES (%s)" % (qn(models.CVR._meta.db_table),
+                                                  ", ".join(qn(c) for c in columns), ", ".join(["%s"] * len(columns)))
+
+    for i in range(0, len(rows), batch_size):
+        # Compare, insert and update as unicode, as the database returns it, so unchanged non-ASCII text matches
+        batch = [(force_text(name), force_text(cvr_text)) for name, cvr_text in rows[i:i + batch_size]]
+        existing = dict(models.CVR.objects.filter(election=election, name__in=[name for name, cvr_text in batch])
+                        .values_list('name', 'cvr_text'))
+
+        new = []
+        for name, cvr_text in batch:
+            if name not in existing:
+                new.append((election.id, name, cvr_text, "Selected", ""))
+                existing[name] = cvr_text
+            elif existing[name] != cvr_text:
+                models.CVR.objects.filter(election=election, name=name).update(cvr_text=cvr_text)
+                existing[name] = cvr_text
+                counts['updated'] += 1
+            else:
+                counts['unchanged'] += 1
+
+        if new:
+            with connection.cursor() as cursor:
+                cursor.executemany(insert, new)
+        counts['created'] += len(new)
+
+    # The inserts bypass the signals which maintain the progress counters, so recount them,
+    # and add the new CVRs to the work queue
+    if counts['created']:
+        models.AuditCounter.rebuild(election.id)
+        models.Assignment.populate(election.id)
+
+    return counts
 
 if __name__ == "__main__":
     main(parser)
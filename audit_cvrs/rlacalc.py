@@ -70,7 +70,11 @@ from math import log, ceil, isnan
 try:
     import hug
 except:
-    import hug_noop as hug
+    try:
+        import hug_noop as hug
+    except ImportError:
+        # e.g. when imported as audit_cvrs.rlacalc by the web application
+        from audit_cvrs import hug_noop as hug
 
 def annotate(annotations):
     """
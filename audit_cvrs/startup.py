@@ -1,4 +1,4 @@
-# Startup code: read in and cache csv file of Cast Vote Records
+# Startup code: set up lookups in the csv file of Cast Vote Records, indexed lazily on the first lookup
 
 from audit_cvrs import cvr
 
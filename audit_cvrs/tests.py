@@ -0,0 +1,208 @@
+"""Django tests of the work queue, the results API and the progress counters.
+Run them via
+
+    ./manage.py test audit_cvrs.tests
+
+(naming the module, since test.py holds the hypothesis tests of rlacalc)
+"""
+
+import json
+import datetime
+from django.test import TestCase
+from django.contrib.auth.models import User
+from django.utils import timezone
+from audit_cvrs.models import CVR, CountyElection, AuditCounter, Assignment, change_status
+
+
+class AuditTestCase(TestCase):
+    "An election with CVRs in two boxes, named as parsers.read_lookup does, and a staff user"
+
+    def setUp(self):
+        self.election = CountyElection.objects.create(name="Test")
+        for i in range(10):
+            CVR.objects.create(election=self.election, name="%d_%d_%s_%d" % (i + 1, i + 1, "P%d" % (i % 2), i + 1),
+                               cvr_text="Ballot %d" % (i + 1), status="Selected")
+        Assignment.populate(self.election.id)
+
+        User.objects.create_superuser('auditor', 'auditor@example.com', 'pw')
+        self.client.login(username='auditor', password='pw')
+
+    def counts(self):
+        "Return the counters for the election, other than the count of changes, as a dictionary"
+
+        return dict(((field, value), count) for field, value, count in
+                    AuditCounter.objects.filter(election=self.election).exclude(field='changes').exclude(count=0)
+                    .values_list('field', 'value', 'count'))
+
+
+class ClaimTest(AuditTestCase):
+
+    def test_no_duplicate_claims(self):
+        "Two teams claiming in turn never get the same CVR, and claims stop when the queue is empty"
+
+        claimed = {}
+        for team in ['A', 'B', 'A', 'B']:
+            for assignment in Assignment.claim(self.election.id, team, 3):
+                self.assertNotIn(assignment.cvr_id, claimed)
+                claimed[assignment.cvr_id] = team
+
+        self.assertEqual(len(claimed), 10)
+        self.assertEqual(Assignment.claim(self.election.id, 'A', 3), [])
+        self.assertEqual(CVR.objects.filter(election=self.election, status="Assigned").count(), 10)
+        for cvr_id, team in claimed.items():
+            self.assertEqual(Assignment.objects.get(cvr_id=cvr_id).team, team)
+
+    def test_claims_in_box_order(self):
+        assignments = Assignment.claim(self.election.id, 'A', 4)
+        self.assertEqual([(a.box, a.position) for a in assignments], [('P0', 1), ('P0', 3), ('P0', 5), ('P0', 7)])
+
+    def test_claim_view(self):
+        "Claims via the view are also disjoint"
+
+        first = json.loads(self.client.post('/claim/', {'team': 'A', 'count': 6}).content)
+        second = json.loads(self.client.post('/claim/', {'team': 'B', 'count': 6}).content)
+        first_ids = set(cvr['id'] for cvr in first['cvrs'])
+        second_ids = set(cvr['id'] for cvr in second['cvrs'])
+        self.assertEqual((len(first_ids), len(second_ids)), (6, 4))
+        self.assertFalse(first_ids & second_ids)
+
+    def test_release_expired(self):
+        "CVRs still Assigned when their assignments expire go back to the queue, but completed ones don't"
+
+        assignments = Assignment.claim(self.election.id, 'A', 3, seconds=60)
+        done = CVR.objects.get(id=assignments[0].cvr_id)
+        done.status = "Completed"
+        done.save()
+
+        Assignment.release_expired(self.election.id, timezone.now())
+        self.assertEqual(Assignment.objects.filter(team='A').count(), 3)
+
+        Assignment.release_expired(self.election.id, timezone.now() + datetime.timedelta(seconds=61))
+        self.assertEqual(list(Assignment.objects.filter(team='A').values_list('cvr', flat=True)), [done.id])
+        self.assertEqual(CVR.objects.filter(election=self.election, status="Assigned").count(), 0)
+        self.assertEqual(CVR.objects.get(id=done.id).status, "Completed")
+
+        # The released CVRs can be claimed again, by another team
+        released = set(a.cvr_id for a in assignments[1:])
+        reclaimed = Assignment.claim(self.election.id, 'B', 10)
+        self.assertTrue(released <= set(a.cvr_id for a in reclaimed))
+        self.assertNotIn(done.id, [a.cvr_id for a in reclaimed])
+
+
+class ResultsTest(AuditTestCase):
+
+    def submit(self, results, **headers):
+        return self.client.post('/results/', json.dumps(dict(results=results)), content_type='application/json', **headers)
+
+    def test_not_modified(self):
+        "Polling with If-None-Match gets 304 until a status or discrepancy changes"
+
+        response = self.client.get('/results/')
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertEqual(len(json.loads(response.content)['cvrs']), 10)
+
+        self.assertEqual(self.client.get('/results/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        cvr = CVR.objects.filter(election=self.election)[0]
+        cvr.notes = "Just a note"
+        cvr.save()
+        self.assertEqual(self.client.get('/results/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        cvr.status = "Other"
+        cvr.save()
+        response = self.client.get('/results/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_stale_if_match(self):
+        "A batch submitted with an out of date If-Match gets 412 and changes nothing"
+
+        etag = self.client.get('/results/')['ETag']
+        name = CVR.objects.filter(election=self.election).order_by('id')[0].name
+
+        response = self.submit([dict(ballot=name, discrepancy=0)], HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['results'][0]['result'], "updated")
+        self.assertNotEqual(response['ETag'], etag)
+
+        other = CVR.objects.filter(election=self.election).order_by('id')[1]
+        response = self.submit([dict(ballot=other.name, discrepancy=1)], HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, 412)
+        self.assertEqual(CVR.objects.get(id=other.id).discrepancy, None)
+
+    def test_recheck_if_match(self):
+        "If-Match is checked again when the batch is saved, for a batch saved after the condition decorator's check"
+
+        from django.test import RequestFactory
+        from audit_cvrs.views import submit_results
+        etag = self.client.get('/results/')['ETag']
+        self.submit([dict(ballot=CVR.objects.filter(election=self.election)[0].name, status="Other")])
+
+        name = CVR.objects.filter(election=self.election).order_by('id')[1].name
+        request = RequestFactory().post('/results/', json.dumps(dict(results=[dict(ballot=name, discrepancy=1)])),
+                                        content_type='application/json', HTTP_IF_MATCH=etag)
+        request.user = User.objects.get(username='auditor')
+        self.assertEqual(submit_results(request, self.election).status_code, 412)
+        self.assertEqual(CVR.objects.get(election=self.election, name=name).discrepancy, None)
+
+    def test_notes_added(self):
+        "Interpretations and notes are added to the notes a CVR has, once"
+
+        cvr = CVR.objects.filter(election=self.election)[0]
+        cvr.notes = "Torn corner"
+        cvr.save()
+        for i in range(2):
+            self.submit([dict(ballot=cvr.name, interpretation="Yes on 1", notes="Checked twice")])
+        self.assertEqual(CVR.objects.get(id=cvr.id).notes, "Torn corner\nInterpretation: Yes on 1\nChecked twice")
+
+    def test_errors(self):
+        name = CVR.objects.filter(election=self.election)[0].name
+        response = self.submit([dict(ballot=name, discrepancy=5), dict(ballot="no such ballot"), dict(ballot=name, status="Other")])
+        self.assertEqual([result['result'] for result in json.loads(response.content)['results']], ["error", "error", "updated"])
+        self.assertEqual(self.submit("not a list").status_code, 400)
+
+
+class CounterTest(AuditTestCase):
+
+    def test_counters_match_rebuild(self):
+        "The counters kept up to date by saves, deletes, status changes, claims and results are the same as a recount"
+
+        cvrs = list(CVR.objects.filter(election=self.election).order_by('id'))
+        self.assertEqual(self.counts()[('total', '')], 10)
+
+        cvrs[0].status = "Completed"
+        cvrs[0].discrepancy = 0
+        cvrs[0].save()
+        cvrs[1].discrepancy = 1
+        cvrs[1].save()
+        cvrs[2].delete()
+        change_status(self.election.id, CVR.objects.filter(id__in=[cvrs[3].id, cvrs[4].id]), "Selected", "Other")
+        Assignment.claim(self.election.id, 'A', 2)
+        self.client.post('/results/', json.dumps(dict(results=[dict(ballot=cvrs[5].name, discrepancy=-1)])),
+                         content_type='application/json')
+        CVR.objects.create(election=self.election, name="11_11_P0_11", cvr_text="Ballot 11", status="Selected")
+
+        counts = self.counts()
+        AuditCounter.rebuild(self.election.id)
+        self.assertEqual(counts, self.counts())
+        self.assertEqual(counts[('total', '')], 10)
+        self.assertEqual(counts[('discrepancy', '-1')], 1)
+
+    def test_progress_sees_other_changes(self):
+        "Progress is cached under the count of changes in the database, so it is never stale, even in another process"
+
+        self.assertEqual(AuditCounter.progress(self.election.id)['status'], {'Selected': 10})
+        # As when another process imports CVRs in bulk and rebuilds the counters
+        CVR.objects.filter(election=self.election, name__in=["1_1_P0_1", "2_2_P1_2", "3_3_P0_3"]).update(status="Completed")
+        AuditCounter.rebuild(self.election.id)
+        self.assertEqual(AuditCounter.progress(self.election.id)['status'], {'Selected': 7, 'Completed': 3})
+
+    def test_delete_election(self):
+        "Deleting an election deletes its counters, without adjusting them for each of its CVRs"
+
+        other = CountyElection.objects.create(name="Other")
+        CVR.objects.create(election=other, name="1_1_P0_1", cvr_text="Ballot 1", status="Selected")
+        self.election.delete()
+        self.assertEqual(AuditCounter.objects.exclude(election=other).count(), 0)
+        self.assertEqual(AuditCounter.objects.get(election=other, field='total').count, 1)
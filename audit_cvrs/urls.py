@@ -2,7 +2,7 @@ from django.conf.urls import include, url
 from django.contrib import admin
 from django.views.generic import TemplateView, ListView
 from audit_cvrs.models import *
-from reversion.models import Revision
+from audit_cvrs.views import SelectionsView, AuditLogView, ProgressView, progress_events, claim_cvrs, results
 
 admin.autodiscover()
 
@@ -14,8 +14,12 @@ urlpatterns = [
     url(r'^$', TemplateView.as_view(template_name="index.html")),
     url(r'^admin/', include(admin.site.urls)),
     #(r'^reports/$',                     'ListView',     dict(cvr_dict, template_name="audit_cvrs/reports.html")),
-    url(r'^selections/$',                  ListView.as_view(model=CVR)),
-    url(r'^auditingLog/$',                 ListView.as_view(model=Revision)),
+    url(r'^selections/$',                  SelectionsView.as_view()),
+    url(r'^auditingLog/$',                 AuditLogView.as_view()),
+    url(r'^progress/$',                    ProgressView.as_view()),
+    url(r'^events/$',                      progress_events),
+    url(r'^claim/$',                       claim_cvrs),
+    url(r'^results/$',                     results),
 ]
 
 #from audit_cvrs import views
@@ -38,6 +38,41 @@ def selection_to_cvr(batch, sequence):
         # Make up a fake filename just retaining batch and sequence numbers
         return "%s_%s.txt" % (batch, sequence.zfill(6))
 
+def name_to_ballot(name):
+    """Return the ballot number in the name of a CVR as made by parsers.read_lookup,
+    which is what its cvr_text was looked up by, or None for other names.
+
+    >>> name_to_ballot('5_73_P0_75')
+    '73'
+    >>> name_to_ballot('ballot') is None
+    True
+    """
+
+    parts = name.split("_", 2)
+    if len(parts) == 3 and parts[1].isdigit():
+        return parts[1]
+    return None
+
+def name_to_box(name):
+    """Return the batch label and the position of the ballot within it, given the name of a CVR
+    as made by parsers.read_lookup: sorted number, ballot, batch label and position, joined by "_".
+    The batch label may itself include "_".  Other names give ('', 0).
+
+    >>> name_to_box('5_73_P0_75')
+    ('P0', 75)
+    >>> name_to_box('2_324_s1_b1_324')
+    ('s1_b1', 324)
+    >>> name_to_box('ballot')
+    ('', 0)
+    """
+
+    parts = name.split("_", 2)
+    if len(parts) == 3:
+        box, sep, position = parts[2].rpartition("_")
+        if sep and position.isdigit():
+            return (box, int(position))
+    return ('', 0)
+
 if __name__ == '__main__':
      import doctest
      doctest.testmod()
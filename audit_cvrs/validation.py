@@ -0,0 +1,203 @@
+"""
+Validate Dominion CVR exports in the same pass as parsing them.
+
+Anomalies are counted by category, and the first few offending records in each
+category are kept as samples, rather than logging every one as it is found.
+Memory use is small even for millions of ballots: duplicate (tabulator, batch,
+record) keys are detected with a bitmap of RecordIds for each batch, up to
+MAX_BITMAP_RECORD, and a set of any others, e.g. huge or negative ones.
+
+>>> v = Validator(contests={1001: 'Mayor'}, candidates={1: 0, 2: 1}, contest_choices={1001: 2})
+>>> session = {'TabulatorId': 2, 'BatchId': 1, 'RecordId': 1}
+>>> v.check_session(session, {'IsCurrent': True}, None)
+>>> v.check_session(session, {'IsCurrent': True}, {'IsCurrent': True})
+>>> v.check_contest(session, {'Id': 1001, 'Marks': [{'CandidateId': 1, 'IsVote': True}, {'CandidateId': 3, 'IsVote': True}]})
+>>> v.check_contest(session, {'Id': 1002, 'Marks': []})
+>>> record = {'IsCurrent': True, 'BallotTypeId': 1, 'PrecinctPortionId': 7, 'Contests': [{'Id': 1001, 'Marks': []}]}
+>>> v.check_record(session, record)
+[{'Id': 1001, 'Marks': []}]
+>>> v.check_record(session, dict(record, Contests=[{'Id': 1001, 'Marks': []}, {'Id': 1001, 'Marks': []}]))
+>>> sorted(v.counts.items())
+[('duplicate_record', 1), ('iscurrent_modified', 1), ('multiple_isvote', 1), ('record_shape', 1), ('unknown_candidate', 1), ('unknown_contest', 1)]
+>>> v.samples['record_shape'][0]['detail']
+'2 contests, more than the 1 in the manifest'
+>>> [(s['TabulatorId'], s['BatchId'], s['RecordId'], s['detail']) for s in v.samples['duplicate_record']]
+[(2, 1, 1, 'seen before')]
+
+Sessions whose records have the wrong shape should be checked with check_record first,
+but check_session copes with missing fields too.
+
+>>> v.check_session({'TabulatorId': 2, 'BatchId': 1, 'RecordId': -5}, {}, None)
+>>> v.check_session({'TabulatorId': 2, 'BatchId': 1, 'RecordId': 10 ** 12}, {'IsCurrent': True}, None)
+>>> v.check_session({'TabulatorId': 2, 'BatchId': 1, 'RecordId': 10 ** 12}, {'IsCurrent': True}, None)
+>>> v.counts['duplicate_record'], v.samples['iscurrent_modified'][-1]['detail']
+(2, 'Original IsCurrent=None with no Modified record')
+"""
+
+import json
+import logging
+import collections
+
+# RecordIds up to this are tracked in a bitmap per batch, using at most 128 KB each
+MAX_BITMAP_RECORD = 1024 * 1024
+
+# Fields every Original or Modified record needs to build a row of the cvr table
+RECORD_FIELDS = ('IsCurrent', 'BallotTypeId', 'PrecinctPortionId')
+
+# Categories of anomalies, in the order they are reported
+CATEGORIES = (
+    'record_shape',
+    'unknown_contest',
+    'unknown_candidate',
+    'multiple_isvote',
+    'iscurrent_modified',
+    'duplicate_record',
+)
+
+
+class Validator(object):
+    "Count anomalies in CVR sessions by category, keeping a few samples of each"
+
+    def __init__(self, contests, candidates, contest_choices=None, max_samples=5):
+        self.contests = contests
+        self.candidates = candidates
+        self.contest_choices = contest_choices or {}    # number of candidates in each contest, per the manifest
+        self.max_samples = max_samples
+        self.counts = collections.Counter()
+        self.samples = collections.defaultdict(list)
+        self.bitmaps = {}       # bytearray for each (tabulator, batch), with a bit for each RecordId seen
+        self.other_records = {} # set for each (tabulator, batch) of RecordIds seen which don't fit the bitmap
+
+    def problem(self, category, session, detail):
+        "Record an anomaly of the given category for the given session"
+
+        self.counts[category] += 1
+        samples = self.samples[category]
+        if len(samples) < self.max_samples:
+            samples.append(collections.OrderedDict([
+                ('TabulatorId', session.get('TabulatorId')), ('BatchId', session.get('BatchId')),
+                ('RecordId', session.get('RecordId')), ('detail', detail)]))
+
+    def check_session(self, session, original, modified):
+        "Check IsCurrent flags of the Original and any Modified record, and check for duplicate records"
+
+        if modified:
+            if original.get('IsCurrent') != False or modified.get('IsCurrent') != True:
+                self.problem('iscurrent_modified', session, "Original IsCurrent=%s, Modified IsCurrent=%s" % (original.get('IsCurrent'), modified.get('IsCurrent')))
+        elif original.get('IsCurrent') != True:
+            self.problem('iscurrent_modified', session, "Original IsCurrent=%s with no Modified record" % original.get('IsCurrent'))
+
+        if self.seen(session.get('TabulatorId'), session.get('BatchId'), session.get('RecordId')):
+            self.problem('duplicate_record', session, "seen before")
+
+    def seen(self, tabulator, batch, record):
+        "Note the given record, and return True if it had been seen before"
+
+        key = (tabulator, batch)
+        if isinstance(record, (int, long)) and 0 <= record <= MAX_BITMAP_RECORD:
+            bitmap = self.bitmaps.setdefault(key, bytearray())
+            byte, bit = record >> 3, 1 << (record & 7)
+            if len(bitmap) <= byte:
+                bitmap.extend(bytearray(byte + 1 - len(bitmap)))
+            seen = bool(bitmap[byte] & bit)
+            bitmap[byte] |= bit
+            return seen
+
+        records = self.other_records.setdefault(key, set())
+        seen = record in records
+        records.add(record)
+        return seen
+
+    def check_contest(self, session, contest):
+        "Check contest and candidate ids, and count IsVote marks"
+
+        if contest['Id'] not in self.contests:
+            self.problem('unknown_contest', session, "ContestId %s" % contest['Id'])
+
+        isvotes = 0
+        for mark in contest['Marks']:
+            if mark['CandidateId'] not in self.candidates:
+                self.problem('unknown_candidate', session, "CandidateId %s in ContestId %s" % (mark['CandidateId'], contest['Id']))
+            if mark['IsVote']:
+                isvotes += 1
+
+        if isvotes > 1:
+            self.problem('multiple_isvote', session, "%d IsVote marks in ContestId %s" % (isvotes, contest['Id']))
+
+    def check_record(self, session, record):
+        """Check the shape of a ballot's Original or Modified record against the manifests, before
+        a row is built from it.  Return its list of contests, or None if it has the wrong shape."""
+
+        detail = self.record_shape(record)
+        if detail:
+            self.problem('record_shape', session, detail)
+            return None
+        return self.record_contests(record)
+
+    def record_contests(self, record):
+        "Return the list of contests in a record, or None if it has none"
+
+        if 'Contests' in record:
+            # e.g. in Dominion Democracy Suite version 4.21.3.0
+            return record['Contests']
+        if record.get('Cards'):
+            # e.g. in Dominion Democracy Suite version 5.5.32.4
+            return record['Cards'][0].get('Contests')
+        return None
+
+    def record_shape(self, record):
+        "Return a description of what is wrong with the shape of a record, or None"
+
+        missing = [name for name in RECORD_FIELDS if name not in record]
+        if missing:
+            return "missing %s" % ", ".join(missing)
+
+        contests = self.record_contests(record)
+        if not isinstance(contests, list):
+            return "no list of Contests"
+        if len(contests) > len(self.contests):
+            return "%d contests, more than the %d in the manifest" % (len(contests), len(self.contests))
+
+        ids = set()
+        for contest in contests:
+            if 'Id' not in contest or not isinstance(contest.get('Marks'), list):
+                return "contest without an Id and a list of Marks"
+            if contest['Id'] in ids:
+                return "ContestId %s more than once" % contest['Id']
+            ids.add(contest['Id'])
+
+            if any('CandidateId' not in mark or 'IsVote' not in mark for mark in contest['Marks']):
+                return "mark without a CandidateId and IsVote in ContestId %s" % contest['Id']
+            marked = len(set(mark['CandidateId'] for mark in contest['Marks']))
+            choices = self.contest_choices.get(contest['Id'])
+            if choices is not None and marked > choices:
+                return "%d candidates marked in ContestId %s, which has %d" % (marked, contest['Id'], choices)
+
+        return None
+
+    def report(self):
+        "Return the counts and samples for each category with anomalies, as an ordered dictionary"
+
+        return collections.OrderedDict(
+            (category, collections.OrderedDict([('count', self.counts[category]), ('samples', self.samples[category])]))
+            for category in CATEGORIES if self.counts[category])
+
+    def log_report(self):
+        "Log a summary of anomalies by category"
+
+        if not self.counts:
+            logging.warning("Validation: no anomalies found")
+
+        for category, result in self.report().items():
+            logging.error("Validation: %d %s anomalies, e.g. %s" % (result['count'], category, json.dumps(result['samples'])))
+
+    def write_report(self, filename):
+        "Write the report as json"
+
+        with open(filename, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+            f.write('\n')
+
+if __name__ == '__main__':
+     import doctest
+     doctest.testmod()
@@ -1,11 +1,539 @@
 import os
+import csv
+import json
 import math
 import operator
 import logging
-from django.http import HttpResponseRedirect, Http404
+import datetime
+from django.http import HttpResponseRedirect, Http404, StreamingHttpResponse, JsonResponse
 from django.shortcuts import render_to_response, get_object_or_404
 from django import forms
 from django.contrib.admin.views.decorators import staff_member_required
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Prefetch, F
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.http import urlencode, parse_etags
+from django.views.decorators.http import require_POST, require_http_methods, condition
+from django.db import transaction
+from reversion import revisions as reversion
+from django.views.generic import ListView, TemplateView
+from reversion.models import Revision, Version
+from audit_cvrs.models import CVR, CountyElection, AuditCounter, Assignment, ASSIGNMENT_SECONDS
+from audit_cvrs import rlacalc
+from audit_cvrs import events
+
+class SelectionsView(ListView):
+    """List the selected CVRs, a page at a time, optionally filtered by status and discrepancy.
+
+    The cvr_text field is deferred, since it is large and not shown.  Pages use keyset
+    pagination: the "after" parameter gives the id of the last CVR on the previous page,
+    so each page is an indexed range scan, and takes the same time however deep it is.
+    Use discrepancy=none for CVRs that haven't been audited yet.
+    """
+
+    model = CVR
+    page_size = 100
+
+    def get_queryset(self):
+        queryset = CVR.objects.defer('cvr_text').order_by('id')
+
+        self.filters = {}
+        for field in ('status', 'discrepancy'):
+            value = self.request.GET.get(field)
+            if value:
+                self.filters[field] = value
+
+        if 'status' in self.filters:
+            queryset = queryset.filter(status=self.filters['status'])
+
+        if 'discrepancy' in self.filters:
+            if self.filters['discrepancy'] == 'none':
+                queryset = queryset.filter(discrepancy__isnull=True)
+            else:
+                try:
+                    queryset = queryset.filter(discrepancy=int(self.filters['discrepancy']))
+                except ValueError:
+                    raise Http404("Bad discrepancy: %s" % self.filters['discrepancy'])
+
+        after = self.request.GET.get('after')
+        if after:
+            try:
+                queryset = queryset.filter(id__gt=int(after))
+            except ValueError:
+                raise Http404("Bad CVR id: %s" % after)
+
+        # Fetch one extra CVR to see if there is a next page
+        return queryset[:self.page_size + 1]
+
+    def get_context_data(self, **kwargs):
+        context = super(SelectionsView, self).get_context_data(**kwargs)
+
+        cvrs = list(context['object_list'])
+        context['object_list'] = cvrs[:self.page_size]
+        context['filters'] = self.filters
+        context['status_choices'] = CVR.STATUS_CHOICES
+        context['discrepancy_choices'] = CVR.DISCREPANCY_CHOICES
+        if len(cvrs) > self.page_size:
+            context['next_page'] = "?" + urlencode(dict(self.filters, after=cvrs[self.page_size - 1].id))
+
+        return context
+
+def parse_time(value):
+    "Return the aware datetime for an ISO 8601 date, or date and time, e.g. 2015-11-24T10:30, in the current time zone"
+
+    try:
+        moment = parse_datetime(value)
+        if moment is None:
+            date = parse_date(value)
+            if date is None:
+                raise ValueError
+            moment = datetime.datetime.combine(date, datetime.time())
+    except ValueError:
+        raise Http404("Bad time: %s" % value)
+
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+class Echo(object):
+    "A pseudo-buffer for csv.writer, which just returns each row to be streamed"
+
+    def write(self, value):
+        return value
+
+class AuditLogView(ListView):
+    """List the revisions of CVRs, i.e. the audit log, a page at a time, optionally filtered
+    by time range (since inclusive, until exclusive), username and CVR name.
+
+    Like SelectionsView, pages use keyset pagination via the "after" parameter, here the id
+    of the last revision on the previous page.  The users and versions of each page are
+    fetched in two extra queries, not one per row.  With format=csv, the whole filtered log
+    is streamed as csv, a chunk of revisions at a time.
+    """
+
+    model = Revision
+    page_size = 100
+    csv_chunk_size = 1000
+    filter_fields = ('since', 'until', 'user', 'cvr')
+    csv_header = ['Timestamp', 'User', 'Revision', 'Selection#_CVR#_Batch_Seq: Status / Discrepancy', 'Changes', 'Notes']
+
+    def filtered_revisions(self):
+        "Return the revisions matching the filters in the request, in order"
+
+        queryset = (Revision.objects.select_related('user')
+                    .prefetch_related(Prefetch('version_set', queryset=Version.objects.only(
+                        'revision', 'object_repr', 'format', 'serialized_data')))
+                    .order_by('id'))
+
+        self.filters = {}
+        for field in self.filter_fields:
+            value = self.request.GET.get(field)
+            if value:
+                self.filters[field] = value
+
+        if 'since' in self.filters:
+            queryset = queryset.filter(date_created__gte=parse_time(self.filters['since']))
+
+        if 'until' in self.filters:
+            queryset = queryset.filter(date_created__lt=parse_time(self.filters['until']))
+
+        if 'user' in self.filters:
+            queryset = queryset.filter(user__username=self.filters['user'])
+
+        if 'cvr' in self.filters:
+            versions = Version.objects.filter(content_type=ContentType.objects.get_for_model(CVR),
+                                              object_id_int__in=CVR.objects.filter(name=self.filters['cvr']).values('id'))
+            queryset = queryset.filter(id__in=versions.values('revision_id'))
+
+        return queryset
+
+    def get_queryset(self):
+        queryset = self.filtered_revisions()
+
+        after = self.request.GET.get('after')
+        if after:
+            try:
+                queryset = queryset.filter(id__gt=int(after))
+            except ValueError:
+                raise Http404("Bad revision id: %s" % after)
+
+        # Fetch one extra revision to see if there is a next page
+        return queryset[:self.page_size + 1]
+
+    def get(self, request, *args, **kwargs):
+        if request.GET.get('format') == 'csv':
+            response = StreamingHttpResponse(self.csv_rows(), content_type="text/csv")
+            response['Content-Disposition'] = 'attachment; filename="auditingLog.csv"'
+            return response
+
+        return super(AuditLogView, self).get(request, *args, **kwargs)
+
+    def csv_rows(self):
+        "Generate the lines of csv for all the filtered revisions"
+
+        writer = csv.writer(Echo())
+        yield writer.writerow(self.csv_header)
+
+        revisions = self.filtered_revisions()
+        last = 0
+        while True:
+            chunk = list(revisions.filter(id__gt=last)[:self.csv_chunk_size])
+            if not chunk:
+                break
+            last = chunk[-1].id
+
+            for revision in chunk:
+                versions = revision.version_set.all()
+                row = [timezone.localtime(revision.date_created).strftime("%Y-%m-%dT%H:%M:%S"),
+                       revision.user or "", revision.id,
+                       ", ".join(version.object_repr for version in versions),
+                       revision.comment,
+                       " ".join(version.field_dict.get('notes', "") for version in versions)]
+                yield writer.writerow([unicode(value).encode('utf-8') for value in row])
+
+    def get_context_data(self, **kwargs):
+        context = super(AuditLogView, self).get_context_data(**kwargs)
+
+        revisions = list(context['object_list'])
+        context['object_list'] = revisions[:self.page_size]
+        context['filters'] = self.filters
+        context['csv_export'] = "?" + urlencode(dict(self.filters, format='csv'))
+        if len(revisions) > self.page_size:
+            context['next_page'] = "?" + urlencode(dict(self.filters, after=revisions[self.page_size - 1].id))
+
+        return context
+
+def audit_risk(progress, alpha, gamma, margin):
+    """Return a dictionary of the number of CVRs audited so far, the counts of each kind of discrepancy,
+    the Kaplan-Markov risk (P-value) they attain, and the estimated number of CVRs still to audit,
+    for the given progress counts from AuditCounter.progress"""
+
+    discrepancies = progress['discrepancy']
+    audited = sum(count for value, count in discrepancies.items() if value != "None")
+    o1, o2, u1, u2 = [discrepancies.get(value, 0) for value in ("1", "2", "-1", "-2")]
+
+    if audited:
+        risk = rlacalc.KM_P_value(audited, gamma, margin, o1, o2, u1, u2)
+        sample_size = rlacalc.nminToGo(audited, alpha, gamma, margin, o1, o2, u1, u2)
+    else:
+        risk = 1.0
+        sample_size = rlacalc.nmin(alpha, gamma, margin, o1, o2, u1, u2)
+
+    estimated = not math.isnan(sample_size)
+    to_go = max(0, int(math.ceil(sample_size)) - audited) if estimated else None
+
+    return dict(audited=audited, o1=o1, o2=o2, u1=u1, u2=u2, risk=risk, met=risk <= alpha,
+                estimated=estimated, sample_size=sample_size, to_go=to_go)
+
+RISK_PARAMETERS = (('alpha', 0.1), ('gamma', 1.03905), ('margin', 0.05))
+
+def risk_parameters(request):
+    "Return a dictionary of the alpha, gamma and margin given in the request, or their defaults"
+
+    parameters = {}
+    for name, default in RISK_PARAMETERS:
+        try:
+            parameters[name] = float(request.GET.get(name) or default)
+        except ValueError:
+            raise Http404("Bad %s: %s" % (name, request.GET[name]))
+    return parameters
+
+def election_risk(progress, parameters):
+    "Return the audit_risk for the given progress and risk parameters, or a dictionary with the error"
+
+    try:
+        return audit_risk(progress, **parameters)
+    except rlacalc.RLAError as e:
+        return dict(error="%s" % e)
+
+class ProgressView(TemplateView):
+    """Show the progress of the audit of each election: the counts of CVRs by status and by
+    discrepancy, the current Kaplan-Markov risk, and the estimated number of CVRs still to audit.
+
+    The counts come from the cached AuditCounter.progress, not from scanning the CVRs.
+    The risk limit (alpha), error inflation factor (gamma) and diluted margin can be given
+    as parameters, as fractions, and default to those of rlacalc.nminToGo.
+    The page is updated as CVRs change via progress_events.
+    """
+
+    template_name = "audit_cvrs/progress.html"
+
+    def get_context_data(self, **kwargs):
+        context = super(ProgressView, self).get_context_data(**kwargs)
+
+        parameters = risk_parameters(self.request)
+        context['parameters'] = parameters
+        context['events'] = "?" + urlencode(parameters)
+
+        elections = []
+        for election in CountyElection.objects.order_by('id'):
+            progress = AuditCounter.progress(election.id)
+            statuses = [(value, label, progress['status'].get(value, 0)) for value, label in CVR.STATUS_CHOICES]
+            statuses += [(value, value, count) for value, count in sorted(progress['status'].items())
+                         if value not in dict(CVR.STATUS_CHOICES)]
+            discrepancies = [("%d" % value, label, progress['discrepancy'].get("%d" % value, 0))
+                             for value, label in CVR.DISCREPANCY_CHOICES]
+            discrepancies.append(("None", "Not yet audited", progress['discrepancy'].get("None", 0)))
+
+            elections.append(dict(election=election, total=progress['total'], statuses=statuses,
+                                  discrepancies=discrepancies, risk=election_risk(progress, parameters)))
+        context['elections'] = elections
+
+        return context
+
+HEARTBEAT_SECONDS = 15
+RETRY_MILLISECONDS = 5000
+
+def progress_event(election_id, parameters):
+    "Return the data for a progress event: the counts for the election, and the risk for the given parameters"
+
+    progress = AuditCounter.progress(election_id)
+    risk = election_risk(progress, parameters)
+    if not risk.get('estimated', True):
+        risk['sample_size'] = None      # NaN is not valid json
+    return dict(progress, election=election_id, risk=risk)
+
+def event_stream(last_id, parameters):
+    """Generate server-sent events for each CVR change after last_id, followed by one progress event
+    for each election with changes, and a comment as a heartbeat when there are none for a while"""
+
+    subscription = events.HUB.subscribe(last_id)
+    try:
+        yield "retry: %d\n\n" % RETRY_MILLISECONDS
+        while True:
+            changes = subscription.get(HEARTBEAT_SECONDS)
+            if subscription.missed:
+                yield events.format_event(None, 'reset', {})
+                return
+
+            if not changes:
+                yield ": heartbeat\n\n"
+                continue
+
+            elections = set()
+            for id, kind, data in changes:
+                yield events.format_event(id, kind, data)
+                elections.add(data['election'])
+            for election_id in sorted(elections):
+                yield events.format_event(None, 'progress', progress_event(election_id, parameters))
+    finally:
+        events.HUB.unsubscribe(subscription)
+
+def progress_events(request):
+    """Stream server-sent events to auditor stations as CVRs change: "cvr" events with the new status
+    and discrepancy of each CVR, and "progress" events with the new counts and risk for its election,
+    for the risk parameters given as for ProgressView.  A "reset" event means events were missed,
+    and the page should be reloaded.  Reconnections resume from the Last-Event-ID if they can."""
+
+    parameters = risk_parameters(request)
+
+    last_id = request.META.get('HTTP_LAST_EVENT_ID')
+    try:
+        last_id = int(last_id) if last_id else None
+    except ValueError:
+        last_id = 0
+
+    response = StreamingHttpResponse(event_stream(last_id, parameters),
+                                     content_type="text/event-stream")
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+MAX_CLAIM = 100
+
+def request_election(request):
+    "Return the election given by id in the request, or the only election if there is just one"
+
+    election_id = request.POST.get('election') or request.GET.get('election')
+    if election_id:
+        try:
+            return CountyElection.objects.get(id=int(election_id))
+        except (ValueError, CountyElection.DoesNotExist):
+            raise Http404("Bad election: %s" % election_id)
+
+    elections = list(CountyElection.objects.all()[:2])
+    if len(elections) != 1:
+        raise Http404("Need an election id")
+    return elections[0]
+
+@staff_member_required
+@require_POST
+def claim_cvrs(request):
+    """Assign the next CVRs waiting to be audited to a team, and return them as json, in order of box
+    and position, with the time the assignment expires.  Parameters: team (default the username),
+    count (default 10, at most MAX_CLAIM), seconds (default ASSIGNMENT_SECONDS) and election
+    (needed if there is more than one).  CVRs which are still Assigned when their assignments
+    expire go back to the queue."""
+
+    election = request_election(request)
+    team = request.POST.get('team') or request.user.get_username()
+    try:
+        count = min(int(request.POST.get('count') or 10), MAX_CLAIM)
+        seconds = int(request.POST.get('seconds') or ASSIGNMENT_SECONDS)
+    except ValueError:
+        raise Http404("Bad count or seconds")
+    if count < 1 or seconds < 1 or len(team) > Assignment._meta.get_field('team').max_length:
+        raise Http404("Bad count, seconds or team")
+
+    assignments = Assignment.claim(election.id, team, count, seconds)
+
+    return JsonResponse(dict(
+        election=election.id, team=team,
+        expires=assignments[0].expires.isoformat() if assignments else None,
+        cvrs=[dict(id=a.cvr_id, name=a.cvr.name, box=a.box, position=a.position) for a in assignments]))
+
+class ResultForm(forms.Form):
+    """The result of auditing one ballot, in a batch of results: the manual interpretation,
+    the discrepancy and notes.  The status defaults to Completed when a discrepancy is given.
+    The interpretation and notes are added to any notes the CVR already has."""
+
+    ballot = forms.CharField(max_length=80)
+    interpretation = forms.CharField(required=False)
+    discrepancy = forms.TypedChoiceField(choices=CVR.DISCREPANCY_CHOICES, coerce=int, empty_value=None, required=False)
+    notes = forms.CharField(required=False)
+    status = forms.ChoiceField(choices=CVR.STATUS_CHOICES, required=False)
+
+    def apply(self, cvr):
+        "Set the fields of the given CVR from the result, and return a list of the fields which changed"
+
+        data = self.cleaned_data
+        new = {}
+        if data['discrepancy'] is not None:
+            new['discrepancy'] = data['discrepancy']
+            new['status'] = "Completed"
+        if data['status']:
+            new['status'] = data['status']
+        added = None
+        if data['interpretation'] or data['notes']:
+            interpretation = "Interpretation: %s" % data['interpretation'] if data['interpretation'] else ""
+            added = "\n".join(text for text in (interpretation, data['notes']) if text)
+            # Don't add the same notes again when a batch is resubmitted
+            if not cvr.notes.endswith(added):
+                new['notes'] = "\n".join(text for text in (cvr.notes, added) if text)
+
+        changes = []
+        for field in ('status', 'discrepancy', 'notes'):
+            if field in new and new[field] != getattr(cvr, field):
+                if field == 'notes':
+                    changes.append("notes: + %s" % added)
+                else:
+                    changes.append("%s: %s -> %s" % (field, getattr(cvr, field), new[field]))
+                setattr(cvr, field, new[field])
+        return changes
+
+MAX_RESULTS = 500
+
+def results_etag(request):
+    "Return an ETag for the selection state of the election, which changes whenever any CVR's status or discrepancy does"
+
+    election = request_election(request)
+    return "%d-%d" % (election.id, AuditCounter.changes(election.id))
+
+def if_match_changes(request, election):
+    """Return the list of counts of changes in the results ETags for the election in the If-Match
+    header, or None if there is no If-Match header, or it is "*" """
+
+    header = request.META.get('HTTP_IF_MATCH')
+    if not header:
+        return None
+    etags = parse_etags(header)
+    if '*' in etags:
+        return None
+
+    changes = []
+    for etag in etags:
+        election_id, sep, count = etag.partition("-")
+        if sep and election_id == str(election.id) and count.isdigit():
+            changes.append(int(count))
+    return changes
+
+@staff_member_required
+@require_http_methods(["GET", "HEAD", "POST"])
+@condition(etag_func=results_etag)
+def results(request):
+    """GET the selection state of the election as json: the id, name, status and discrepancy of each CVR,
+    optionally filtered by box, team or status.  The ETag only changes when a status or discrepancy
+    does, so stations can poll with If-None-Match and get "304 Not Modified" until then.
+
+    POST a batch of results as json, {"results": [{"ballot": name, "interpretation": ..., "discrepancy": ...,
+    "notes": ...}, ...]}, up to MAX_RESULTS of them.  Each is validated, and the valid ones are all saved
+    in one transaction and one revision.  The response has a result for each, in the same order:
+    "updated", "unchanged" or "error", with the changes or errors.  With If-Match, the batch is only
+    accepted if the selection state hasn't changed since that ETag.
+    """
+
+    election = request_election(request)
+
+    if request.method == "POST":
+        return submit_results(request, election)
+
+    cvrs = CVR.objects.filter(election=election).order_by('id')
+    for field, lookup in (('box', 'assignment__box'), ('team', 'assignment__team'), ('status', 'status')):
+        value = request.GET.get(field)
+        if value:
+            cvrs = cvrs.filter(**{lookup: value})
+
+    return JsonResponse(dict(election=election.id, cvrs=[
+        dict(id=id, name=name, status=status, discrepancy=discrepancy)
+        for id, name, status, discrepancy in cvrs.values_list('id', 'name', 'status', 'discrepancy')]))
+
+def submit_results(request, election):
+    "Validate and save a batch of results for the results view"
+
+    try:
+        items = json.loads(request.body)['results']
+        if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+            raise ValueError
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse(dict(error="Need json with a list of results"), status=400)
+    if len(items) > MAX_RESULTS:
+        return JsonResponse(dict(error="At most %d results at a time" % MAX_RESULTS), status=400)
+
+    submissions = [ResultForm(item) for item in items]
+    names = [form.cleaned_data['ballot'] for form in submissions if form.is_valid()]
+
+    output = []
+    comments = []
+    seen = set()
+    expected = if_match_changes(request, election)
+    with transaction.atomic():
+        # The condition decorator checked If-Match, but another batch may have been saved since.
+        # Check again via an update, which also takes the write lock until this batch is saved.
+        if expected is not None and not (AuditCounter.objects.filter(election=election, field='changes', count__in=expected)
+                                         .update(count=F('count'))):
+            return JsonResponse(dict(error="The results have changed since the If-Match ETag"), status=412)
+
+        # Not deferring cvr_text, since in Django 1.9 instances with deferred fields are of a proxy
+        # class, whose saves the signal receivers and reversion wouldn't see
+        cvrs = dict((cvr.name, cvr) for cvr in CVR.objects.filter(election=election, name__in=names))
+
+        with reversion.create_revision():
+            for form in submissions:
+                if not form.is_valid():
+                    output.append(dict(ballot=form.data.get('ballot'), result="error", errors=form.errors))
+                    continue
+
+                name = form.cleaned_data['ballot']
+                cvr = cvrs.get(name)
+                if cvr is None or name in seen:
+                    error = "Duplicate ballot in this batch" if cvr else "No such ballot"
+                    output.append(dict(ballot=name, result="error", errors=dict(ballot=[error])))
+                    continue
+                seen.add(name)
+
+                changes = form.apply(cvr)
+                if changes:
+                    cvr.save(update_fields=['status', 'discrepancy', 'notes'])
+                    comments.append("%s: %s" % (name, "; ".join(changes)))
+                output.append(dict(ballot=name, result="updated" if changes else "unchanged", changes=changes))
+
+            reversion.set_user(request.user)
+            reversion.set_comment("\n".join(comments))
+
+    response = JsonResponse(dict(election=election.id, results=output))
+    response['ETag'] = '"%s"' % results_etag(request)
+    return response
 
 def report(request, contest):
     "Generate Kaplan-Markov audit report for selected ContestBatches"
@@ -0,0 +1,235 @@
+"""
+Output writers for tables of CVR data: plain csv, compressed csv, Parquet and Arrow.
+
+Rows are collected into chunks and each chunk is written with a single large
+write (or a single row group / record batch), rather than one write per row.
+
+Usage:
+
+    writer = open_writer("cvr.csv.gz", ["TabulatorId", "BatchId", ...])
+    for row in rows:
+        writer.writerow(row)
+    writer.close()
+
+The format is inferred from the file name unless given explicitly.  Writing
+csv.zst needs the zstandard module, and parquet or arrow need pyarrow.
+
+>>> import io
+>>> f = io.BytesIO()
+>>> w = CSVWriter(f, ["Id", "Contest\\tName"], chunk_rows=2)
+>>> for row in [(1, True), (2, False), (3, True)]:
+...     w.writerow(row)
+>>> f.getvalue().decode('utf-8') == 'Id,"Contest\\tName"\\n1,True\\n2,False\\n'
+True
+>>> w.flush()
+>>> f.getvalue().decode('utf-8').count('\\n')
+4
+"""
+
+import io
+import os
+import sys
+import gzip
+import logging
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+FORMATS = ('csv', 'csv.gz', 'csv.zst', 'parquet', 'arrow')
+
+CHUNK_ROWS = 10000
+
+
+def format_for(filename):
+    """Return the output format implied by the given file name, or 'csv' by default
+
+    >>> format_for("cvr.csv.gz")
+    'csv.gz'
+    >>> format_for("cvr.parquet")
+    'parquet'
+    >>> format_for("cvr.feather")
+    'arrow'
+    >>> format_for(None)
+    'csv'
+    """
+
+    if filename:
+        if filename.endswith(".gz"):
+            return 'csv.gz'
+        if filename.endswith(".zst"):
+            return 'csv.zst'
+        if filename.endswith(".parquet"):
+            return 'parquet'
+        if filename.endswith((".arrow", ".feather")):
+            return 'arrow'
+
+    return 'csv'
+
+
+def _csv_field(field):
+    "Quote a header field for csv if it contains special characters"
+
+    if any(c in field for c in ',"\t\n'):
+        return '"%s"' % field.replace('"', '""')
+    return field
+
+
+class CSVWriter(object):
+    """Write rows to a binary file object as utf-8 csv, a chunk at a time.
+
+    Data fields are written with str() and are not quoted, which suits the
+    numeric and boolean values in CVR tables.  The header is quoted as needed.
+    """
+
+    def __init__(self, f, header, chunk_rows=CHUNK_ROWS, closefile=None, write_header=True):
+        self.f = f
+        self.chunk_rows = chunk_rows
+        self.closefile = closefile
+        self.rows = []
+        self.count = 0
+        if write_header:
+            self._write(','.join(_csv_field(h) for h in header) + '\n')
+
+    def _write(self, text):
+        self.f.write(text.encode('utf-8'))
+
+    def writerow(self, row):
+        self.rows.append(','.join([str(v) for v in row]))
+        if len(self.rows) >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self._write('\n'.join(self.rows) + '\n')
+            self.count += len(self.rows)
+            self.rows = []
+
+    def checkpoint(self):
+        "Write out all buffered rows, sync them to disk, and return the file offset to resume from"
+
+        self.flush()
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        return self.f.tell()
+
+    def close(self):
+        self.flush()
+        self.f.flush()
+        if self.closefile:
+            self.closefile()
+
+
+class ArrowWriter(object):
+    """Write rows as Parquet row groups or Arrow record batches, a chunk at a time.
+
+    Column types are inferred from the first chunk, and later chunks are cast to match.
+    """
+
+    def __init__(self, filename, header, format='parquet', chunk_rows=CHUNK_ROWS):
+        if pyarrow is None:
+            raise ImportError("pyarrow is needed to write %s files" % format)
+
+        self.filename = filename
+        self.header = list(header)
+        self.format = format
+        self.chunk_rows = chunk_rows
+        self.rows = []
+        self.count = 0
+        self.schema = None
+        self.writer = None
+
+    def writerow(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+
+        columns = [pyarrow.array(list(column)) for column in zip(*self.rows)]
+        table = pyarrow.Table.from_arrays(columns, names=self.header)
+
+        if self.writer is None:
+            self.schema = table.schema
+            if self.format == 'parquet':
+                self.writer = pyarrow.parquet.ParquetWriter(self.filename, self.schema)
+            else:
+                self.writer = pyarrow.RecordBatchFileWriter(self.filename, self.schema)
+        else:
+            table = table.cast(self.schema)
+
+        self.writer.write_table(table)
+        self.count += len(self.rows)
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+
+
+def open_writer(filename, header, format=None, chunk_rows=CHUNK_ROWS, offset=None):
+    """Return a writer for rows with the given header, in the given format.
+    If filename is None or "-", write csv to stdout.
+
+    If offset is given, resume writing an existing plain csv file from an earlier
+    checkpoint: truncate it to offset and append to it, without a new header.
+    """
+
+    if format is None:
+        format = format_for(filename)
+
+    if format not in FORMATS:
+        raise ValueError("Unknown output format %s: use one of %s" % (format, ", ".join(FORMATS)))
+
+    logging.info("Writing %s output to %s" % (format, filename or "stdout"))
+
+    if format in ('parquet', 'arrow'):
+        if filename in (None, "-"):
+            raise ValueError("Need an output file name for %s format" % format)
+        return ArrowWriter(filename, header, format, chunk_rows)
+
+    if filename in (None, "-"):
+        if format != 'csv':
+            raise ValueError("Need an output file name for %s format" % format)
+        return CSVWriter(getattr(sys.stdout, 'buffer', sys.stdout), header, chunk_rows)
+
+    if offset is not None:
+        if format != 'csv':
+            raise ValueError("Can only resume writing plain csv files, not %s" % format)
+        f = io.open(filename, 'r+b')
+        f.truncate(offset)
+        f.seek(offset)
+        return CSVWriter(f, header, chunk_rows, f.close, write_header=False)
+
+    f = io.open(filename, 'wb')
+
+    if format == 'csv.gz':
+        out = gzip.GzipFile(filename=os.path.basename(filename), mode='wb', fileobj=f)
+    elif format == 'csv.zst':
+        if zstandard is None:
+            f.close()
+            raise ImportError("zstandard is needed to write %s files" % format)
+        out = zstandard.ZstdCompressor().stream_writer(f)
+    else:
+        return CSVWriter(f, header, chunk_rows, f.close)
+
+    def closefile():
+        out.close()
+        if not f.closed:
+            f.close()
+
+    return CSVWriter(out, header, chunk_rows, closefile)
+
+if __name__ == '__main__':
+     import doctest
+     doctest.testmod()